@@ -30,6 +30,7 @@ import pwem
 import pyworkflow.utils as pwutils
 
 import spoc.constants as spocConst
+from spoc import runner
 
 __version__ = "1.0.6"
 _logo = "spoc_logo.png"
@@ -38,6 +39,10 @@ _url = "https://github.com/scipion-em/scipion-em-spoc"
 
 
 SCRATCHDIR = pwutils.getEnvVariable('SPOCSCRATCHDIR', default='/tmp/')
+CACHEDIR = pwutils.getEnvVariable('SPOCCACHEDIR',
+                                  default=os.path.expanduser('~/.cache/scipion-spoc'))
+CACHESIZE = float(pwutils.getEnvVariable('SPOCCACHESIZE', default=50))
+SHELLCACHE = pwutils.envVarOn('SPOCSHELLCACHE')
 
 
 class Plugin(pwem.Plugin):
@@ -69,16 +74,39 @@ class Plugin(pwem.Plugin):
     def isVersion(cls, version=spocConst.V_CB):
         return cls.getActiveVersion() == version
 
+    @classmethod
+    def getSourcePath(cls, *paths):
+        """ Return a path inside the SPOC sources folder. """
+        return os.path.join(cls.getHome('spoc-source'), *paths)
+
+    @classmethod
+    def getShellCachePath(cls):
+        """ Folder for the FSC shell indices shared by all runs, or None when
+        the SPOCSHELLCACHE variable is not enabled. """
+        return cls.getHome('shell-cache') if SHELLCACHE else None
+
     @classmethod
     def getProgram(cls, program):
         """ Return the program binary that will be used. """
-        program = os.path.join(cls.getHome('spoc-source'), program)
+        program = cls.getSourcePath(program)
         return 'python %(program)s ' % locals()
 
     @classmethod
     def getSpocCommand(cls, program, args):
         return cls.getProgram(program) + args
 
+    @classmethod
+    def runSpoc(cls, protocol, program, args, cwd=None, inProcess=True):
+        """ Run a SPOC script. If inProcess is True the script is executed
+        inside the current interpreter, falling back to a separate process
+        when it can not be imported here. """
+        script = cls.getSourcePath(program)
+        if inProcess and runner.canRunInProcess(script):
+            print(cls.getSpocCommand(program, args), flush=True)
+            runner.runScript(script, args, cwd=cwd)
+        else:
+            protocol.runJob(cls.getProgram(program), args, cwd=cwd)
+
     @classmethod
     def defineBinaries(cls, env):
         # For Spoc-CB
@@ -0,0 +1,139 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team (scipion@cnb.csic.es)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+
+
+"""
+Content addressed cache of SPOC results.
+
+Each entry is a folder of SPOCCACHEDIR named after a key computed from the
+checksums of the input files and the parameters of the computation. Entries
+are evicted in least recently used order when the cache grows beyond
+SPOCCACHESIZE (in GB).
+"""
+
+import hashlib
+import os
+import shutil
+
+import pyworkflow.utils as pwutils
+
+import spoc
+
+LOG_FILE = 'cached_log.txt'
+BLOCK_SIZE = 16 * 1024 * 1024
+
+
+def fileChecksum(fileName):
+    """ SHA-256 of the content of a file. """
+    sha = hashlib.sha256()
+    with open(fileName, 'rb') as f:
+        for block in iter(lambda: f.read(BLOCK_SIZE), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def getCacheKey(files, **params):
+    """ Key of a computation from its input files and parameters. """
+    sha = hashlib.sha256()
+    for fileName in files:
+        sha.update(fileChecksum(fileName).encode())
+    for name in sorted(params):
+        sha.update(('%s=%r;' % (name, params[name])).encode())
+    return sha.hexdigest()
+
+
+def _getEntryPath(key):
+    return os.path.join(spoc.CACHEDIR, key)
+
+
+def _linkOrCopy(source, dest):
+    pwutils.cleanPath(dest)
+    try:
+        os.link(source, dest)
+    except OSError:
+        shutil.copy(source, dest)
+
+
+def retrieve(key, outputDir):
+    """ Link the files of a cache entry into outputDir. Return False if the
+    entry does not exist. """
+    entry = _getEntryPath(key)
+    if not os.path.isdir(entry):
+        return False
+    pwutils.makePath(outputDir)
+    for fileName in os.listdir(entry):
+        if fileName == LOG_FILE:
+            with open(os.path.join(entry, LOG_FILE)) as f:
+                print(f.read(), flush=True)
+        else:
+            _linkOrCopy(os.path.join(entry, fileName), os.path.join(outputDir, fileName))
+    # Entry modification time is used as last access time for the eviction
+    os.utime(entry)
+    print("Results retrieved from cache entry %s" % entry, flush=True)
+    return True
+
+
+def store(key, outputDir, logLines=()):
+    """ Store all the files of outputDir (and optionally some log lines to be
+    printed back on retrieval) as a new cache entry. """
+    entry = _getEntryPath(key)
+    if os.path.isdir(entry):
+        return
+    tmpEntry = '%s.tmp%d' % (entry, os.getpid())
+    pwutils.makePath(tmpEntry)
+    for fileName in os.listdir(outputDir):
+        source = os.path.join(outputDir, fileName)
+        if os.path.isfile(source):
+            _linkOrCopy(source, os.path.join(tmpEntry, fileName))
+    if logLines:
+        with open(os.path.join(tmpEntry, LOG_FILE), 'w') as f:
+            f.write(''.join(logLines))
+    try:
+        os.rename(tmpEntry, entry)
+    except OSError:
+        # Stored at the same time by another run
+        pwutils.cleanPath(tmpEntry)
+    evict()
+
+
+def _getSize(path):
+    return sum(os.path.getsize(os.path.join(path, f)) for f in os.listdir(path))
+
+
+def evict(maxSize=None):
+    """ Remove the least recently used entries until the cache size is below
+    maxSize (SPOCCACHESIZE by default), in GB. """
+    maxSize = spoc.CACHESIZE if maxSize is None else maxSize
+    if not os.path.isdir(spoc.CACHEDIR):
+        return
+    entries = [os.path.join(spoc.CACHEDIR, e) for e in os.listdir(spoc.CACHEDIR)]
+    entries = sorted((e for e in entries if os.path.isdir(e)), key=os.path.getmtime)
+    sizes = {e: _getSize(e) for e in entries}
+    totalSize = sum(sizes.values())
+    for entry in entries:
+        if totalSize <= maxSize * 1024 ** 3:
+            break
+        pwutils.cleanPath(entry)
+        totalSize -= sizes[entry]
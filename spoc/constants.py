@@ -40,3 +40,16 @@ V1_0 = '1.0'
 #  V_CB = '1.0_220105' (Stable version 1.0 and commit downloaded on the 05/01/2022)
 COMMIT = '55b4f82'
 V_CB = '1.0_220105'
+
+# Resolution analysis engines
+ENGINE_SPOC = 0
+ENGINE_SINGLE_PASS = 1
+
+# Confidence map engines
+CONFIDENCE_ENGINE_SPOC = 0
+CONFIDENCE_ENGINE_CHUNKED = 1
+
+# Precision of the arrays of the NumPy engines
+PRECISION_FLOAT32 = 0
+PRECISION_FLOAT64 = 1
+PRECISION_DTYPES = {PRECISION_FLOAT32: 'float32', PRECISION_FLOAT64: 'float64'}
@@ -0,0 +1,244 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team (scipion@cnb.csic.es)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+
+
+"""
+Conversion of the input maps to the files consumed by SPOC.
+"""
+
+from contextlib import contextmanager
+import hashlib
+import os
+import shutil
+
+import mrcfile
+import numpy as np
+
+from pwem.emlib.image import ImageHandler
+import pyworkflow.utils as pwutils
+
+import spoc
+
+MRC_EXTENSIONS = ['.mrc', '.map']
+MRC_MODE_FLOAT32 = 2
+
+STATS_SUFFIX = '_stats.npz'
+STATS_BINS = 1024
+STATS_PERCENTILES = [1, 5, 25, 50, 75, 95, 99]
+STATS_SLICE_SIZE = 256
+
+
+def isCompliantMrc(fileName, samplingRate, tolerance=1e-3):
+    """ Check if a file is already a float32 MRC volume with a cubic box, the
+    expected voxel size and no extended header, so SPOC can read it as it is. """
+    if (':' in fileName or '@' in fileName or
+            pwutils.getExt(fileName).lower() not in MRC_EXTENSIONS or
+            not os.path.exists(fileName)):
+        return False
+    try:
+        with mrcfile.open(fileName, header_only=True, permissive=True) as mrc:
+            header = mrc.header
+            voxelSize = mrc.voxel_size
+    except Exception:
+        return False
+
+    dims = (int(header.nx), int(header.ny), int(header.nz))
+    return (int(header.mode) == MRC_MODE_FLOAT32 and int(header.nsymbt) == 0 and
+            dims[2] > 1 and len(set(dims)) == 1 and
+            all(abs(float(v) - samplingRate) <= tolerance * samplingRate
+                for v in (voxelSize.x, voxelSize.y, voxelSize.z)) and
+            os.path.getsize(fileName) >=
+            1024 + 4 * dims[0] * dims[1] * dims[2])
+
+
+def stageMap(fileName, stagedFile, samplingRate):
+    """ Make fileName available as stagedFile. Compliant MRC files are linked
+    (hard link when possible, symbolic link otherwise) and the rest are
+    converted with ImageHandler. Return True if the file was linked. """
+    pwutils.cleanPath(stagedFile)
+    if isCompliantMrc(fileName, samplingRate):
+        source = os.path.abspath(fileName)
+        try:
+            os.link(source, stagedFile)
+        except OSError:
+            os.symlink(source, stagedFile)
+        print("%s linked as %s" % (fileName, stagedFile))
+        return True
+
+    if pwutils.getExt(fileName) == '.mrc':
+        fileName += ':mrc'
+    ImageHandler().convert(fileName, stagedFile)
+    return False
+
+
+def getScratchPath(protocol, *paths):
+    """ Path inside the scratch folder (SPOCSCRATCHDIR) of a protocol run. The
+    folder name is unique for each protocol working directory. """
+    workingDir = os.path.abspath(protocol.getWorkingDir())
+    key = hashlib.md5(workingDir.encode()).hexdigest()[:12]
+    folder = 'spoc_%s_%s' % (os.path.basename(workingDir), key)
+    return os.path.join(spoc.SCRATCHDIR, folder, *paths)
+
+
+@contextmanager
+def scratchFolder(protocol, enabled=True):
+    """ Context of a step that uses the scratch folder of a protocol run. The
+    folder is removed at the end, also when the step fails. """
+    try:
+        yield getScratchPath(protocol)
+    finally:
+        if enabled:
+            pwutils.cleanPath(getScratchPath(protocol))
+
+
+def retrieveOutputs(scratchDir, outputDir):
+    """ Copy all the files written by SPOC in scratchDir to outputDir. """
+    pwutils.makePath(outputDir)
+    for fileName in os.listdir(scratchDir):
+        source = os.path.join(scratchDir, fileName)
+        if os.path.isfile(source):
+            shutil.copy(source, os.path.join(outputDir, fileName))
+
+
+def parseResolution(logFile):
+    """ Global resolution reported in the last 'Resolution at 1 % FDR-FSC'
+    line of the output of FSC_FDRcontrol.py, or None if there is none. """
+    res = None
+    with open(logFile) as file:
+        for line in file:
+            if 'Resolution at 1 % FDR-FSC' in line:
+                res = [float(s) for s in line.split() if s.replace(".", "", 1).isdigit()][1]
+    return res
+
+
+def getMrcShape(fileName):
+    """ (z, y, x) dimensions of an MRC file, read from its header. """
+    with mrcfile.open(fileName, header_only=True, permissive=True) as mrc:
+        header = mrc.header
+        return int(header.nz), int(header.ny), int(header.nx)
+
+
+def readSlices(fileName, sliceNumbers, axis='z'):
+    """ Read some slices along the given axis ('x', 'y' or 'z') of an MRC
+    volume through a memory map, so the rest of the volume is not loaded. """
+    axisIndex = {'z': 0, 'y': 1, 'x': 2}[axis]
+    slices = []
+    with mrcfile.mmap(fileName, mode='r', permissive=True) as mrc:
+        for sliceNumber in sliceNumbers:
+            index = [slice(None)] * 3
+            index[axisIndex] = int(sliceNumber)
+            slices.append(np.array(mrc.data[tuple(index)]))
+    return slices
+
+
+def computeHistogram(fileName, bins=10, minValue=None, maxValue=None,
+                     slabSize=32):
+    """ Histogram of the values v of an MRC volume with minValue < v <= maxValue
+    (no limit when None). The volume is memory mapped and processed in slabs
+    of slabSize z slices. Return the counts and the bin edges. """
+    def _selected(slab):
+        slab = np.asarray(slab)
+        keep = np.isfinite(slab)
+        if minValue is not None:
+            keep &= slab > minValue
+        if maxValue is not None:
+            keep &= slab <= maxValue
+        return slab[keep]
+
+    with mrcfile.mmap(fileName, mode='r', permissive=True) as mrc:
+        data = mrc.data
+        slabs = range(0, data.shape[0], slabSize)
+        low, high = np.inf, -np.inf
+        for z in slabs:
+            values = _selected(data[z:z + slabSize])
+            if values.size:
+                low, high = min(low, values.min()), max(high, values.max())
+        if low > high:
+            return np.zeros(bins, dtype=np.int64), np.linspace(0, 1, bins + 1)
+
+        edges = np.linspace(low, high, bins + 1)
+        counts = np.zeros(bins, dtype=np.int64)
+        for z in slabs:
+            counts += np.histogram(_selected(data[z:z + slabSize]), bins=edges)[0]
+    return counts, edges
+
+
+def rebinHistogram(counts, edges, bins):
+    """ Merge a fine histogram into the given number of bins. """
+    newEdges = np.linspace(edges[0], edges[-1], bins + 1)
+    centers = (edges[:-1] + edges[1:]) / 2
+    return np.histogram(centers, bins=newEdges, weights=counts)[0], newEdges
+
+
+def getCentralSlices(size):
+    """ The volume size is divided in 9 segments and the fourth central ones
+    are selected i.e. 3,4,5,6 """
+    return [int(i * size / 9) for i in range(3, 7)]
+
+
+def getStatisticsFile(fileName):
+    return pwutils.removeExt(fileName) + STATS_SUFFIX
+
+
+def writeMapStatistics(fileName, minValue=None):
+    """ Write next to an output map a small NPZ file with its range, a fine
+    histogram, some percentiles and downsampled central slices along each
+    axis, computed from the values above minValue. Viewers read this file
+    instead of the whole map. """
+    counts, edges = computeHistogram(fileName, bins=STATS_BINS, minValue=minValue)
+    cumulative = np.cumsum(counts)
+    if cumulative[-1]:
+        percentiles = np.interp(np.array(STATS_PERCENTILES) / 100.0 * cumulative[-1],
+                                cumulative, edges[1:])
+    else:
+        percentiles = np.zeros(len(STATS_PERCENTILES))
+
+    stats = {'cutoff': np.nan if minValue is None else minValue,
+             'minValue': edges[0], 'maxValue': edges[-1],
+             'counts': counts, 'edges': edges,
+             'percentileLevels': np.array(STATS_PERCENTILES),
+             'percentiles': percentiles}
+    for axis, size in zip('zyx', getMrcShape(fileName)):
+        sliceNumbers = getCentralSlices(size)
+        slices = readSlices(fileName, sliceNumbers, axis)
+        step = max(1, int(np.ceil(max(slices[0].shape) / float(STATS_SLICE_SIZE))))
+        stats['sliceNumbers_%s' % axis] = np.array(sliceNumbers)
+        stats['slices_%s' % axis] = np.array([s[::step, ::step] for s in slices])
+    np.savez(getStatisticsFile(fileName), **stats)
+
+
+def loadMapStatistics(fileName):
+    """ Statistics written by writeMapStatistics or None if there are none
+    (e.g. runs from previous versions). """
+    statsFile = getStatisticsFile(fileName)
+    if not os.path.exists(statsFile):
+        return None
+    with np.load(statsFile) as stats:
+        return dict(stats)
+
+
+def getMedian(stats):
+    levels = list(stats['percentileLevels'])
+    return float(stats['percentiles'][levels.index(50)])
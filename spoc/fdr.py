@@ -0,0 +1,368 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team (scipion@cnb.csic.es)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+
+
+"""
+Chunked implementation of the FDR confidence maps (Beckers et al. 2019) used
+by ProtConfidenceMap for maps that do not fit in memory. The map is memory
+mapped and processed in slabs of z slices: the background noise is estimated
+once from the noise boxes, the voxel p-values are computed slab by slab and
+the FDR adjustment is done from a streamed histogram of the z-scores.
+"""
+
+import collections
+import zipfile
+
+import numpy as np
+from scipy.stats import norm
+import mrcfile
+
+SLAB_SIZE = 16
+NUM_BINS = 2 ** 16
+METHOD_BH = 'BH'
+METHOD_BY = 'BY'
+METHOD_BONFERRONI = 'Bonferroni'
+FDR_LEVEL = 0.01
+# Candidate noise boxes whose standard deviation exceeds the median one by
+# this factor, or whose mean differs from the median one by this fraction
+# of the median standard deviation, are considered to overlap signal
+NOISE_STD_TOLERANCE = 1.25
+NOISE_MEAN_TOLERANCE = 0.5
+MODEL_POOLED = 0
+MODEL_BEST = 1
+
+NoiseBoxStats = collections.namedtuple('NoiseBoxStats',
+                                       ['count', 'mean', 'std', 'max', 'signal'])
+
+
+def getNoiseBoxes(shape, boxSize=None, center=None):
+    """ Noise estimation regions as tuples of slices. By default four boxes at
+    the corners of the central slices, otherwise one box around center,
+    given as (x, y, z) voxel coordinates. """
+    nz, ny, nx = shape
+    if not boxSize:
+        boxSize = max(nx // 10, 8)
+    boxSize = int(boxSize)
+    half = boxSize // 2
+
+    def _box(z, y, x):
+        return tuple(slice(int(min(max(c - half, 0), n - boxSize)),
+                           int(min(max(c - half, 0), n - boxSize)) + boxSize)
+                     for c, n in zip((z, y, x), shape))
+
+    if center is not None:
+        x, y, z = center
+        return [_box(z, y, x)]
+    return [_box(nz // 2, y, x) for y in (half, ny - half) for x in (half, nx - half)]
+
+
+def estimateNoise(data, boxes):
+    """ Mean and standard deviation of the voxels of all the noise boxes. """
+    values = np.concatenate([np.asarray(data[box], dtype=np.float64).ravel()
+                             for box in boxes])
+    return values.mean(), values.std()
+
+
+def parseNoiseBoxes(text):
+    """ List of (x, y, z) box centers from a 'x y z; x y z; ...' string. """
+    centers = []
+    for item in text.replace(',', ' ').split(';'):
+        if item.strip():
+            values = item.split()
+            if len(values) != 3:
+                raise ValueError("Noise box centers must be given as 'x y z', "
+                                 "got '%s'" % item.strip())
+            centers.append(tuple(float(v) for v in values))
+    return centers
+
+
+def noiseBoxStatistics(data, boxes, slabSize=SLAB_SIZE):
+    """ Statistics of every candidate noise box, gathered in one pass over
+    the slabs of the (memory mapped) map, and whether they overlap signal. """
+    count = np.zeros(len(boxes))
+    total = np.zeros(len(boxes))
+    squares = np.zeros(len(boxes))
+    maxima = np.full(len(boxes), -np.inf)
+    for slab in _slabs(data.shape[0], slabSize):
+        for i, box in enumerate(boxes):
+            z0, z1 = max(box[0].start, slab.start), min(box[0].stop, slab.stop)
+            if z0 >= z1:
+                continue
+            values = np.asarray(data[z0:z1, box[1], box[2]], dtype=np.float64)
+            count[i] += values.size
+            total[i] += values.sum()
+            squares[i] += np.square(values).sum()
+            maxima[i] = max(maxima[i], values.max())
+
+    mean = total / count
+    std = np.sqrt(np.maximum(squares / count - mean ** 2, 0))
+    refMean, refStd = np.median(mean), np.median(std)
+    signal = ((std > NOISE_STD_TOLERANCE * refStd) |
+              (np.abs(mean - refMean) > NOISE_MEAN_TOLERANCE * refStd))
+    return NoiseBoxStats(count, mean, std, maxima, signal)
+
+
+def selectNoiseModel(stats, model=MODEL_POOLED):
+    """ Mean, standard deviation and indexes of the boxes used for the noise
+    model: the pooled statistics of the boxes without signal (all of them if
+    every box overlaps signal) or the box with the lowest deviation. """
+    if model == MODEL_BEST:
+        used = np.array([np.argmin(stats.std)])
+    else:
+        used = np.flatnonzero(~stats.signal)
+        if not len(used):
+            used = np.arange(len(stats.count))
+    count = stats.count[used]
+    mean = np.sum(stats.mean[used] * count) / count.sum()
+    squares = np.sum((stats.std[used] ** 2 + stats.mean[used] ** 2) * count)
+    return mean, np.sqrt(max(squares / count.sum() - mean ** 2, 0)), used
+
+
+def evaluateNoiseBoxes(inputFile, centers, boxSize=None, model=MODEL_POOLED,
+                       slabSize=SLAB_SIZE):
+    """ Statistics of the candidate noise boxes centered at centers (x, y, z)
+    and the noise model chosen from them. Return the noise mean and std, the
+    NoiseBoxStats of the candidates and the indexes of the boxes used. """
+    with mrcfile.mmap(inputFile, mode='r', permissive=True) as mrc:
+        boxes = [getNoiseBoxes(mrc.data.shape, boxSize, center)[0]
+                 for center in centers]
+        stats = noiseBoxStatistics(mrc.data, boxes, slabSize)
+    mean, std, used = selectNoiseModel(stats, model)
+    return mean, std, stats, used
+
+
+def writeNoiseReport(fileName, centers, stats, used):
+    """ Text table with the statistics of each candidate noise box. """
+    with open(fileName, 'w') as f:
+        f.write('%-6s %-24s %12s %12s %12s  %s\n'
+                % ('box', 'center (x y z)', 'mean', 'std', 'max', 'status'))
+        for i, center in enumerate(centers):
+            status = 'signal' if stats.signal[i] else 'noise'
+            if i in used:
+                status += ', used'
+            f.write('%-6d %-24s %12.5g %12.5g %12.5g  %s\n'
+                    % (i + 1, ' '.join('%g' % c for c in center), stats.mean[i],
+                       stats.std[i], stats.max[i], status))
+
+
+def _slabs(nz, slabSize):
+    return [slice(z, min(z + slabSize, nz)) for z in range(0, nz, slabSize)]
+
+
+def harmonicNumber(m):
+    """ Benjamini-Yekutieli correction sum(1/i) for i in 1..m, asymptotic
+    expansion for large m to avoid allocating m values. """
+    if m <= 10 ** 6:
+        return np.sum(1.0 / np.arange(1, m + 1))
+    return np.log(m) + np.euler_gamma + 0.5 / m - 1.0 / (12.0 * m ** 2)
+
+
+def adjustedPValuesTable(counts, edges, method=METHOD_BY):
+    """ FDR (Benjamini-Yekutieli or Benjamini-Hochberg) or FWER (Bonferroni)
+    adjusted p-value of each z-score bin. The voxels of a bin share the
+    p-value of its lower edge (the largest one) and the rank of its last
+    voxel in the ascending order of p-values. """
+    m = counts.sum()
+    # Number of voxels with a p-value lower than or equal to the bin ones
+    ranks = np.cumsum(counts[::-1])[::-1]
+    pValues = norm.sf(edges[:-1])
+    if method == METHOD_BONFERRONI:
+        return np.minimum(pValues * m, 1.0)
+    correction = harmonicNumber(m) if method == METHOD_BY else 1.0
+    with np.errstate(divide='ignore', invalid='ignore'):
+        raw = np.where(ranks > 0, pValues * m * correction / ranks, 1.0)
+    # Step-up procedure: minimum over the bins with larger p-values
+    return np.minimum(np.minimum.accumulate(raw), 1.0)
+
+
+def confidenceMap(inputFile, confidenceFile, log10File, apix, boxSize=None,
+                  center=None, method=METHOD_BY, slabSize=SLAB_SIZE,
+                  numBins=NUM_BINS, dtype=np.float64, noise=None,
+                  zScoresFile=None):
+    """ Compute the confidence map (1 - adjusted p-values) and the -log10 FDR
+    map of inputFile keeping in memory only a few slabs of slabSize slices.
+    The slabs are processed in the given precision, while the noise statistics,
+    the histogram and the adjusted p-values are computed in float64. The
+    noise (mean, std) is estimated from the noise boxes unless given. If
+    zScoresFile is given, the voxel z-scores, from which the p-values can be
+    computed again by rethreshold, are also stored there (see iterZScores).
+    Return the noise mean and standard deviation. Raise ValueError if the
+    standard deviation is 0. """
+    with mrcfile.mmap(inputFile, mode='r', permissive=True) as mrc:
+        data = mrc.data
+        if noise is None:
+            mean, std = estimateNoise(data, getNoiseBoxes(data.shape, boxSize, center))
+        else:
+            mean, std = noise
+        if not std > 0:
+            raise ValueError("The standard deviation of the background noise is %s, "
+                             "so the z-scores are not defined. Choose noise boxes "
+                             "that are not constant (e.g. outside the zero padding "
+                             "of the box)" % std)
+        slabMean, slabStd = np.dtype(dtype).type(mean), np.dtype(dtype).type(std)
+
+        def _zScores():
+            for slab in _slabs(data.shape[0], slabSize):
+                yield (np.asarray(data[slab], dtype=dtype) - slabMean) / slabStd
+
+        _writeAdjustedMaps(_zScores, data.shape, slabSize, confidenceFile, log10File,
+                           apix, method, numBins, zScoresFile=zScoresFile)
+    return mean, std
+
+
+def rethreshold(zScoresFile, confidenceFile, log10File, apix, method=METHOD_BY,
+                slabSize=SLAB_SIZE, numBins=NUM_BINS, maskFile=None,
+                fdrLevel=FDR_LEVEL):
+    """ Compute again the confidence and -log10 FDR maps from the z-scores
+    stored by confidenceMap with another adjustment method and, if maskFile
+    is given, the mask of the voxels significant at fdrLevel. The p-values
+    are obtained from the z-scores in float64, so neither tail is lost. """
+    shape = readZScoresShape(zScoresFile)
+
+    def _zScores():
+        for zScores in iterZScores(zScoresFile, slabSize):
+            yield zScores.astype(np.float64)
+
+    _writeAdjustedMaps(_zScores, shape, slabSize, confidenceFile, log10File, apix,
+                       method, numBins, maskFile=maskFile, fdrLevel=fdrLevel)
+
+
+def _writeAdjustedMaps(zScores, shape, slabSize, confidenceFile, log10File, apix,
+                       method, numBins, zScoresFile=None, maskFile=None,
+                       fdrLevel=FDR_LEVEL):
+    # Adjusted p-values of the z-scores of the slabs yielded by zScores(),
+    # from the histogram of all of them, written slab by slab
+    low, high = np.inf, -np.inf
+    for values in zScores():
+        low, high = min(low, values.min()), max(high, values.max())
+    edges = np.linspace(low, high, numBins + 1)
+    counts = np.zeros(numBins, dtype=np.int64)
+    for values in zScores():
+        counts += np.histogram(values, bins=edges)[0]
+    qTable = adjustedPValuesTable(counts, edges, method)
+
+    tiny = np.finfo(np.float32).tiny
+    outputs = [(confidenceFile, lambda q: 1 - q),
+               (log10File, lambda q: -np.log10(np.maximum(q, tiny)))]
+    if maskFile:
+        outputs.append((maskFile, lambda q: q <= fdrLevel))
+    mrcs = [(mrcfile.new_mmap(fileName, shape, mrc_mode=2, overwrite=True),
+             _HeaderStats(), func) for fileName, func in outputs]
+    zScoresWriter = _ZScoresWriter(zScoresFile, shape) if zScoresFile else None
+    try:
+        for slab, values in zip(_slabs(shape[0], slabSize), zScores()):
+            bins = np.clip(np.searchsorted(edges, values, side='right') - 1,
+                           0, numBins - 1)
+            qValues = qTable[bins]
+            for outputMrc, stats, func in mrcs:
+                outputMrc.data[slab] = func(qValues)
+                stats.add(outputMrc.data[slab])
+            if zScoresWriter:
+                zScoresWriter.write(values)
+        for outputMrc, stats, _ in mrcs:
+            stats.write(outputMrc, apix)
+    finally:
+        for outputMrc, _, _ in mrcs:
+            outputMrc.close()
+        if zScoresWriter:
+            zScoresWriter.close()
+
+
+# --------------------------- z-scores file -----------------------------------
+# The voxel z-scores are stored as a float32 array named ZSCORES_KEY in a
+# compressed npz file (readable with numpy.load), written and read slab by
+# slab. Unlike float32 p-values, they keep both tails of the distribution.
+ZSCORES_KEY = 'zScores'
+
+
+class _ZScoresWriter:
+    """ Stream the slabs of a float32 array into a compressed npz file. """
+    def __init__(self, fileName, shape):
+        self._zip = zipfile.ZipFile(fileName, 'w', compression=zipfile.ZIP_DEFLATED)
+        self._file = self._zip.open(ZSCORES_KEY + '.npy', 'w', force_zip64=True)
+        np.lib.format.write_array_header_1_0(
+            self._file, {'descr': np.lib.format.dtype_to_descr(np.dtype(np.float32)),
+                         'fortran_order': False, 'shape': tuple(shape)})
+
+    def write(self, slab):
+        self._file.write(np.ascontiguousarray(slab, dtype=np.float32).tobytes())
+
+    def close(self):
+        self._file.close()
+        self._zip.close()
+
+
+def _openZScores(zipFile):
+    # Open the z-scores array member and read its header
+    member = zipFile.open(ZSCORES_KEY + '.npy')
+    version = np.lib.format.read_magic(member)
+    readHeader = (np.lib.format.read_array_header_1_0 if version == (1, 0)
+                  else np.lib.format.read_array_header_2_0)
+    shape, _, dtype = readHeader(member)
+    return member, shape, dtype
+
+
+def readZScoresShape(fileName):
+    with zipfile.ZipFile(fileName) as zipFile:
+        member, shape, _ = _openZScores(zipFile)
+        member.close()
+    return shape
+
+
+def iterZScores(fileName, slabSize=SLAB_SIZE):
+    """ Yield the stored z-scores in slabs of slabSize z sections,
+    decompressing the file sequentially. """
+    with zipfile.ZipFile(fileName) as zipFile:
+        member, shape, dtype = _openZScores(zipFile)
+        with member:
+            sectionBytes = int(np.prod(shape[1:])) * dtype.itemsize
+            for slab in _slabs(shape[0], slabSize):
+                sections = slab.stop - slab.start
+                data = member.read(sections * sectionBytes)
+                yield np.frombuffer(data, dtype=dtype).reshape((sections,) + tuple(shape[1:]))
+
+
+class _HeaderStats:
+    """ Running min, max, mean and rms of a map written in slabs, to avoid
+    mrcfile update_header_stats making full size temporary copies. """
+    def __init__(self):
+        self.n, self.total, self.squares = 0, 0.0, 0.0
+        self.min, self.max = np.inf, -np.inf
+
+    def add(self, values):
+        values = np.asarray(values, dtype=np.float64)
+        self.n += values.size
+        self.total += values.sum()
+        self.squares += np.square(values).sum()
+        self.min = min(self.min, values.min())
+        self.max = max(self.max, values.max())
+
+    def write(self, mrc, apix):
+        mean = self.total / self.n
+        mrc.voxel_size = apix
+        mrc.header.dmin = self.min
+        mrc.header.dmax = self.max
+        mrc.header.dmean = mean
+        mrc.header.rms = np.sqrt(max(self.squares / self.n - mean ** 2, 0.0))
@@ -0,0 +1,835 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team (scipion@cnb.csic.es)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+
+
+"""
+NumPy implementation of the FDR-FSC resolution analysis (Beckers and Sachse,
+2020) used by the single pass mode of ProtResolutionAnalysisFSCFDR. Both half
+maps are loaded once and used for the global FDR-FSC curve and for the local
+resolution map.
+
+The maps, their transforms and the local resolution map keep the precision
+of the input arrays (float32 or float64). The shell sums, correlations and
+p-values are always accumulated in float64.
+"""
+
+import collections
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+import os
+import sys
+
+import numpy as np
+from scipy import fft, ndimage
+from scipy.stats import norm
+import mrcfile
+
+FDR_LEVEL = 0.01
+NUM_PERMUTATIONS = 1000
+MAX_PERMUTATION_SAMPLES = 5000
+# Elements of the (permutations, coefficients) blocks of the vectorized test
+PERMUTATION_BLOCK = 2 ** 20
+WINDOW_SIZE = 20
+STEP_SIZE = 5
+# Local windows transformed together by the batched scan
+BATCH_SIZE = 256
+# Adaptive scan: coarse grid spacing (in steps) and refinement tolerance
+# (in Fourier shells of the window)
+COARSE_FACTOR = 4
+REFINE_TOLERANCE = 1.0
+# Generic direction whose Dirichlet domain is the asymmetric unit
+SYMMETRY_REFERENCE = np.array([0.137, 0.291, 0.947])
+# Preview: Nyquist of the cropped maps relative to the global resolution
+PREVIEW_MARGIN = 1.5
+# Preview: smallest window (in voxels of the cropped maps)
+PREVIEW_MIN_WINDOW = 8
+# Local resolution value of the voxels outside the mask
+OUTSIDE_MASK = 0
+FSC_TXT = 'FSC.txt'
+FSC_NPY = 'FSC.npy'
+FSC_PDF = 'FSC.pdf'
+
+# Shell indices and counts by box shape, see getShellIndices
+SHELL_CACHE_SIZE = 8
+_shellCache = collections.OrderedDict()
+_shellCounts = {}
+_shellCacheDir = None
+
+FdrFscResult = collections.namedtuple('FdrFscResult',
+                                      ['frequencies', 'fsc', 'threshold',
+                                       'pValues', 'qValues', 'resolution'])
+
+
+# --------------------------- I/O functions -----------------------------------
+def readMap(fileName, dtype=np.float64):
+    with mrcfile.open(fileName, permissive=True) as mrc:
+        return np.array(mrc.data, dtype=dtype)
+
+
+def writeMap(fileName, data, apix):
+    with mrcfile.new(fileName, overwrite=True) as mrc:
+        mrc.set_data(np.asarray(data, dtype=np.float32))
+        mrc.voxel_size = apix
+
+
+def writeFsc(path, result):
+    """ Write FSC.txt and FSC.npy (frequency, FSC and FDR threshold rows) and
+    FSC.pdf. """
+    curve = np.array([result.frequencies, result.fsc, result.threshold])
+    np.savetxt(os.path.join(path, FSC_TXT), curve)
+    np.save(os.path.join(path, FSC_NPY), curve)
+
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    fig = Figure()
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot(111)
+    ax.plot(result.frequencies, result.fsc, label='FSC')
+    ax.plot(result.frequencies, result.threshold, '--',
+            label='%d %% FDR threshold' % (FDR_LEVEL * 100))
+    ax.axvline(1.0 / result.resolution, color='grey', linestyle=':')
+    ax.set_xlabel('Spatial frequency (1/Angstrom)')
+    ax.set_ylabel('Correlation')
+    ax.set_title('Resolution at %d %% FDR-FSC: %.2f Angstrom'
+                 % (FDR_LEVEL * 100, result.resolution))
+    ax.legend()
+    fig.savefig(os.path.join(path, FSC_PDF))
+
+
+def loadCurve(path):
+    """ Return the FSC curve rows (frequency, FSC and, when available, the
+    FDR threshold) from FSC.npy, creating it from FSC.txt if needed (e.g. when
+    it was written by FSC_FDRcontrol.py). """
+    npyFile = os.path.join(path, FSC_NPY)
+    if not os.path.exists(npyFile):
+        np.save(npyFile, np.loadtxt(os.path.join(path, FSC_TXT), ndmin=2))
+    return np.load(npyFile)
+
+
+# --------------------------- Statistics functions ----------------------------
+def getSymmetryOrder(sym):
+    """ Number of asymmetric units of a symmetry string (C1, Cn, Dn, T, O, I). """
+    sym = sym.upper()
+    if sym[:1] in ('C', 'D') and sym[1:].isdigit():
+        return int(sym[1:]) * (2 if sym[0] == 'D' else 1)
+    return {'T': 12, 'O': 24, 'I': 60}.get(sym[:1], 1)
+
+
+def setShellCacheDir(path):
+    """ Also keep the shell indices computed by getShellIndices as files in
+    path, to be reused by other runs with the same box size. None disables
+    the disk cache. """
+    global _shellCacheDir
+    _shellCacheDir = path
+
+
+def _computeShellIndices(shape):
+    freqs = [np.fft.fftfreq(n) for n in shape[:-1]] + [np.fft.rfftfreq(shape[-1])]
+    grids = np.meshgrid(*freqs, indexing='ij', sparse=True)
+    radius = np.sqrt(sum(g ** 2 for g in grids)) * shape[0]
+    return np.rint(radius).astype(np.int64)
+
+
+def _loadShellIndices(shape):
+    if not _shellCacheDir:
+        return _computeShellIndices(shape)
+    fileName = os.path.join(_shellCacheDir, 'shells_%s.npy' % 'x'.join(map(str, shape)))
+    try:
+        return np.load(fileName).astype(np.int64)
+    except (OSError, ValueError):
+        pass
+    indices = _computeShellIndices(shape)
+    try:
+        os.makedirs(_shellCacheDir, exist_ok=True)
+        tmpFile = '%s.%d.tmp.npy' % (fileName[:-4], os.getpid())
+        # Stored in the smallest type, radii never exceed 2 * max(shape)
+        np.save(tmpFile, indices.astype(np.min_scalar_type(2 * max(shape))))
+        os.replace(tmpFile, fileName)
+    except OSError as e:
+        print("WARNING: could not store the shell indices in %s: %s"
+              % (_shellCacheDir, e), file=sys.stderr, flush=True)
+    return indices
+
+
+def _axisRotation(axis, fold):
+    # Rotation matrix of 2 pi / fold radians around axis (x, y, z)
+    x, y, z = np.asarray(axis, dtype=float) / np.linalg.norm(axis)
+    angle = 2 * np.pi / fold
+    c, s, t = np.cos(angle), np.sin(angle), 1 - np.cos(angle)
+    return np.array([[c + x * x * t, x * y * t - z * s, x * z * t + y * s],
+                     [y * x * t + z * s, c + y * y * t, y * z * t - x * s],
+                     [z * x * t - y * s, z * y * t + x * s, c + z * z * t]])
+
+
+def getSymmetryMatrices(sym):
+    """ Rotation matrices (acting on x, y, z coordinates, identity first) of
+    the point group of a symmetry string: Cn around z, Dn with a two fold
+    along x, T and O with two/four fold axes along x, y, z, I (or I1) with
+    two fold axes along x, y, z and five folds in the yz plane, and I2 with
+    the five folds in the xz plane. Raise ValueError for other strings. """
+    sym = sym.upper()
+    phi = (1 + np.sqrt(5)) / 2
+    if sym[:1] in ('C', 'D') and sym[1:].isdigit() and int(sym[1:]) > 0:
+        generators = [_axisRotation((0, 0, 1), int(sym[1:]))]
+        if sym[0] == 'D':
+            generators.append(_axisRotation((1, 0, 0), 2))
+    elif sym == 'T':
+        generators = [_axisRotation((0, 0, 1), 2), _axisRotation((1, 1, 1), 3)]
+    elif sym == 'O':
+        generators = [_axisRotation((0, 0, 1), 4), _axisRotation((1, 1, 1), 3)]
+    elif sym in ('I', 'I1', 'I2'):
+        fiveFold = (0, 1, phi) if sym != 'I2' else (-1, 0, phi)
+        generators = [_axisRotation((0, 0, 1), 2), _axisRotation((1, 1, 1), 3),
+                      _axisRotation(fiveFold, 5)]
+    else:
+        raise ValueError("Unsupported symmetry: %s" % sym)
+
+    group = [np.eye(3)]
+    keys = {np.eye(3).round(6).tobytes()}
+    newElements = list(group)
+    while newElements:
+        products = [m @ g for m in newElements for g in generators]
+        newElements = []
+        for m in products:
+            key = (m.round(6) + 0.0).tobytes()
+            if key not in keys:
+                keys.add(key)
+                newElements.append(m)
+        group.extend(newElements)
+    return np.array(group)
+
+
+def getShellIndices(shape):
+    """ Integer radial shell of every coefficient of numpy.fft.rfftn for a
+    volume of the given shape. The indices only depend on the shape, so they
+    are cached in memory for the SHELL_CACHE_SIZE most recently used shapes
+    (and in the shell cache folder, if set) and returned as a read only
+    array. """
+    shape = tuple(int(n) for n in shape)
+    if shape in _shellCache:
+        _shellCache.move_to_end(shape)
+    else:
+        if len(_shellCache) >= SHELL_CACHE_SIZE:
+            _shellCounts.pop(_shellCache.popitem(last=False)[0], None)
+        indices = _loadShellIndices(shape)
+        indices.flags.writeable = False
+        _shellCache[shape] = indices
+    return _shellCache[shape]
+
+
+def getShellCounts(shape):
+    """ Number of rfftn coefficients of each shell up to Nyquist
+    (shape[0] // 2 + 1 shells) for a volume of the given shape. """
+    shape = tuple(int(n) for n in shape)
+    if shape not in _shellCounts:
+        nShells = shape[0] // 2 + 1
+        counts = np.bincount(np.minimum(getShellIndices(shape), nShells).ravel(),
+                             minlength=nShells + 1)[:nShells]
+        counts.flags.writeable = False
+        _shellCounts[shape] = counts
+    return _shellCounts[shape]
+
+
+def _shellSum(shells, nShells, weights):
+    # Coefficients beyond Nyquist are accumulated in an extra bin and dropped
+    return np.bincount(shells, weights=weights.ravel(), minlength=nShells + 1)[:nShells]
+
+
+def shellCorrelations(f1, f2, shells, nShells):
+    """ Fourier shell correlation of two rfftn transforms. """
+    shells = np.minimum(shells, nShells).ravel()
+    num = _shellSum(shells, nShells, (f1 * np.conj(f2)).real)
+    den = np.sqrt(_shellSum(shells, nShells, np.abs(f1) ** 2) *
+                  _shellSum(shells, nShells, np.abs(f2) ** 2))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        fsc = num / den
+    fsc[~np.isfinite(fsc)] = 0
+    return fsc
+
+
+def permutationNull(f1, f2, shells, nShells, numPermutations=NUM_PERMUTATIONS,
+                    seed=0):
+    """ Mean and standard deviation of the shell correlations when the
+    coefficients of the second map are randomly permuted inside each shell.
+    Large shells are subsampled and the statistics rescaled to the full shell. """
+    rng = np.random.default_rng(seed)
+    shells = np.minimum(shells, nShells).ravel()
+    a1, a2 = f1.ravel(), f2.ravel()
+    order = np.argsort(shells, kind='stable')
+    bounds = np.searchsorted(shells[order], np.arange(nShells + 1))
+    mean = np.zeros(nShells)
+    std = np.ones(nShells)
+
+    for shell in range(1, nShells):
+        idx = order[bounds[shell]:bounds[shell + 1]]
+        n = len(idx)
+        if n < 2:
+            continue
+        if n > MAX_PERMUTATION_SAMPLES:
+            idx = rng.choice(idx, MAX_PERMUTATION_SAMPLES, replace=False)
+        a, b = a1[idx], a2[idx]
+        den = np.sqrt(np.sum(np.abs(a) ** 2) * np.sum(np.abs(b) ** 2))
+        if den == 0:
+            continue
+        null = np.empty(numPermutations)
+        for i in range(numPermutations):
+            null[i] = np.sum((a * np.conj(b[rng.permutation(len(b))])).real) / den
+        scale = np.sqrt(len(idx) / n)
+        mean[shell] = null.mean() * scale
+        std[shell] = max(null.std() * scale, np.finfo(float).eps)
+    return mean, std
+
+
+def permutationNullVectorized(f1, f2, shells, nShells,
+                              numPermutations=NUM_PERMUTATIONS, seed=0):
+    """ Same as permutationNull, but one matrix of permutations of the largest
+    shell sample is drawn and shared by all the shells: keeping, in order, the
+    entries below n of a random permutation gives a random permutation of n
+    elements. Going from the largest shell to the smallest one, each shell
+    takes its permutations from those of the previous one and gets all its
+    correlations from one gather and one matrix-vector product. Permutations
+    are drawn in blocks of about PERMUTATION_BLOCK elements. """
+    rng = np.random.default_rng(seed)
+    shells = np.minimum(shells, nShells).ravel()
+    a1, a2 = f1.ravel(), f2.ravel()
+    order = np.argsort(shells, kind='stable')
+    bounds = np.searchsorted(shells[order], np.arange(nShells + 1))
+    mean = np.zeros(nShells)
+    std = np.ones(nShells)
+
+    samples = []
+    for shell in range(1, nShells):
+        idx = order[bounds[shell]:bounds[shell + 1]]
+        n = len(idx)
+        if n < 2:
+            continue
+        if n > MAX_PERMUTATION_SAMPLES:
+            idx = rng.choice(idx, MAX_PERMUTATION_SAMPLES, replace=False)
+        a, b = a1[idx], a2[idx]
+        den = np.sqrt(np.sum(np.abs(a) ** 2) * np.sum(np.abs(b) ** 2))
+        if den > 0:
+            samples.append((shell, n, np.conj(a), b, den))
+    if not samples:
+        return mean, std
+    samples.sort(key=lambda sample: -len(sample[3]))
+
+    maxSize = len(samples[0][3])
+    nulls = np.empty((len(samples), numPermutations))
+    blockSize = max(PERMUTATION_BLOCK // maxSize, 1)
+    for start in range(0, numPermutations, blockSize):
+        block = min(blockSize, numPermutations - start)
+        perms = rng.permuted(np.tile(np.arange(maxSize, dtype=np.int32), (block, 1)),
+                             axis=1)
+        for i, (_, _, conjA, b, den) in enumerate(samples):
+            perms = perms[perms < len(b)].reshape(block, len(b))
+            # sum(a * conj(b')) and sum(b' * conj(a)) have the same real part
+            nulls[i, start:start + block] = (b[perms] @ conjA).real / den
+
+    for (shell, n, _, b, _), null in zip(samples, nulls):
+        scale = np.sqrt(len(b) / n)
+        mean[shell] = null.mean() * scale
+        std[shell] = max(null.std() * scale, np.finfo(float).eps)
+    return mean, std
+
+
+def permutationStd(f1, f2, shells, nShells, counts=None):
+    """ Closed form standard deviation of the shell correlations under random
+    permutation of the (zero mean) coefficients inside each shell. Used for
+    the local windows, where sampling permutations would be too expensive.
+    counts are the number of coefficients of each shell, computed from shells
+    if not given. """
+    shells = np.minimum(shells, nShells).ravel()
+    r1, i1, r2, i2 = f1.real, f1.imag, f2.real, f2.imag
+    count = (np.bincount(shells, minlength=nShells + 1)[:nShells]
+             if counts is None else counts)
+    rr = _shellSum(shells, nShells, r1 * r1) * _shellSum(shells, nShells, r2 * r2)
+    ii = _shellSum(shells, nShells, i1 * i1) * _shellSum(shells, nShells, i2 * i2)
+    ri = _shellSum(shells, nShells, r1 * i1) * _shellSum(shells, nShells, r2 * i2)
+    den = (_shellSum(shells, nShells, r1 * r1 + i1 * i1) *
+           _shellSum(shells, nShells, r2 * r2 + i2 * i2))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        std = np.sqrt((rr + 2 * ri + ii) / (np.maximum(count, 2) - 1) / den)
+    std[~np.isfinite(std) | (std == 0)] = 1
+    return std
+
+
+def fdrControl(pValues, level=FDR_LEVEL):
+    """ Benjamini-Hochberg adjusted p-values and the p-value cutoff that
+    controls the FDR at the given level. """
+    m = len(pValues)
+    order = np.argsort(pValues)
+    ranked = pValues[order] * m / np.arange(1, m + 1)
+    qValues = np.empty(m)
+    qValues[order] = np.minimum(np.minimum.accumulate(ranked[::-1])[::-1], 1)
+    significant = qValues <= level
+    pCutoff = pValues[significant].max() if significant.any() else level / m
+    return qValues, pCutoff
+
+
+def getResolution(qValues, boxSize, apix, level=FDR_LEVEL):
+    """ Resolution of the last shell before the first non significant one. """
+    significant = qValues[1:] <= level
+    lastShell = len(significant) if significant.all() else np.argmin(significant)
+    return boxSize * apix / max(lastShell, 1)
+
+
+def fdrControlRows(pValues, level=FDR_LEVEL):
+    """ Benjamini-Hochberg adjusted p-values of each row of pValues. """
+    m = pValues.shape[1]
+    order = np.argsort(pValues, axis=1)
+    ranked = np.take_along_axis(pValues, order, axis=1) * m / np.arange(1, m + 1)
+    adjusted = np.minimum(np.minimum.accumulate(ranked[:, ::-1], axis=1)[:, ::-1], 1)
+    qValues = np.empty_like(adjusted)
+    np.put_along_axis(qValues, order, adjusted, axis=1)
+    return qValues
+
+
+def getResolutionRows(qValues, boxSize, apix, level=FDR_LEVEL):
+    """ getResolution of each row of qValues (without the zero shell). """
+    significant = qValues <= level
+    lastShell = np.where(significant.all(axis=1), significant.shape[1],
+                         np.argmin(significant, axis=1))
+    return boxSize * apix / np.maximum(lastShell, 1)
+
+
+# --------------------------- Resolution functions ----------------------------
+def globalFsc(half1, half2, apix, numAsymUnits=1, level=FDR_LEVEL,
+              numPermutations=NUM_PERMUTATIONS, seed=0, vectorized=False):
+    """ FSC between the half maps thresholded by FDR control of the
+    permutation p-values of each shell. With vectorized the permutation null
+    is computed by permutationNullVectorized. """
+    boxSize = half1.shape[0]
+    nShells = boxSize // 2 + 1
+    shells = getShellIndices(half1.shape)
+    f1, f2 = fft.rfftn(half1), fft.rfftn(half2)
+    fsc = shellCorrelations(f1, f2, shells, nShells)
+    nullFunc = permutationNullVectorized if vectorized else permutationNull
+    mean, std = nullFunc(f1, f2, shells, nShells,
+                         numPermutations=numPermutations, seed=seed)
+    # Symmetry reduces the number of independent coefficients per shell
+    std *= np.sqrt(numAsymUnits)
+
+    pValues = np.zeros(nShells)
+    pValues[1:] = norm.sf(fsc[1:], loc=mean[1:], scale=std[1:])
+    qValues = np.zeros(nShells)
+    qValues[1:], pCutoff = fdrControl(pValues[1:], level)
+    threshold = mean + std * norm.isf(pCutoff)
+    threshold[0] = fsc[0]
+
+    return FdrFscResult(frequencies=np.arange(nShells) / (boxSize * apix),
+                        fsc=fsc, threshold=threshold, pValues=pValues,
+                        qValues=qValues,
+                        resolution=getResolution(qValues, boxSize, apix, level))
+
+
+def windowResolution(w1, w2, shells, nShells, apix, numAsymUnits=1,
+                     level=FDR_LEVEL):
+    """ FDR-FSC resolution of a pair of (tapered) local windows. """
+    f1, f2 = fft.rfftn(w1), fft.rfftn(w2)
+    fsc = shellCorrelations(f1, f2, shells, nShells)
+    std = permutationStd(f1, f2, shells, nShells,
+                         getShellCounts(w1.shape)) * np.sqrt(numAsymUnits)
+    qValues = np.zeros(nShells)
+    qValues[1:], _ = fdrControl(norm.sf(fsc[1:] / std[1:]), level)
+    return getResolution(qValues, w1.shape[0], apix, level)
+
+
+def scanWindows(half1, half2, centers, windowSize, apix, numAsymUnits=1,
+                level=FDR_LEVEL, evaluate=None):
+    """ FDR-FSC resolution of the windows centered on the grid given by the
+    three arrays of centers (in voxels of half1/half2). If given, only the
+    windows where the boolean grid evaluate is True are computed, the rest
+    are set to OUTSIDE_MASK. """
+    halfWindow = windowSize // 2
+    taper = np.hanning(windowSize)
+    taper = taper[:, None, None] * taper[None, :, None] * taper[None, None, :]
+    taper = taper.astype(half1.dtype)
+    shells = getShellIndices((windowSize,) * 3)
+    nShells = windowSize // 2 + 1
+
+    coarse = np.full([len(c) for c in centers], OUTSIDE_MASK, dtype=half1.dtype)
+    for i, z in enumerate(centers[0]):
+        for j, y in enumerate(centers[1]):
+            for k, x in enumerate(centers[2]):
+                if evaluate is not None and not evaluate[i, j, k]:
+                    continue
+                window = (slice(z - halfWindow, z - halfWindow + windowSize),
+                          slice(y - halfWindow, y - halfWindow + windowSize),
+                          slice(x - halfWindow, x - halfWindow + windowSize))
+                coarse[i, j, k] = windowResolution(half1[window] * taper,
+                                                   half2[window] * taper,
+                                                   shells, nShells, apix,
+                                                   numAsymUnits, level)
+    return coarse
+
+
+def getBatchShellOffsets(windowSize, batchSize):
+    """ Shell index of every rfftn coefficient of a stack of batchSize
+    windows, offset by nShells + 1 per window, so that one bincount gives the
+    shell sums of all of them. """
+    nShells = windowSize // 2 + 1
+    shells = np.minimum(getShellIndices((windowSize,) * 3), nShells).ravel()
+    return shells[None, :] + (nShells + 1) * np.arange(batchSize)[:, None]
+
+
+def batchWindowResolutions(f1, f2, offsets, windowSize, apix, numAsymUnits=1,
+                           level=FDR_LEVEL):
+    """ windowResolution of a stack of window transforms, given as
+    (windows, coefficients) arrays, in one vectorized pass. """
+    nWindows = f1.shape[0]
+    nShells = windowSize // 2 + 1
+    offsets = offsets[:nWindows].ravel()
+
+    def _sum(weights):
+        sums = np.bincount(offsets, weights=weights.ravel(),
+                           minlength=nWindows * (nShells + 1))
+        return sums.reshape(nWindows, nShells + 1)[:, :nShells]
+
+    r1, i1, r2, i2 = f1.real, f1.imag, f2.real, f2.imag
+    count = getShellCounts((windowSize,) * 3)
+    rr1, ii1, rr2, ii2 = _sum(r1 * r1), _sum(i1 * i1), _sum(r2 * r2), _sum(i2 * i2)
+    den = (rr1 + ii1) * (rr2 + ii2)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        fsc = _sum(r1 * r2 + i1 * i2) / np.sqrt(den)
+        std = np.sqrt((rr1 * rr2 + 2 * _sum(r1 * i1) * _sum(r2 * i2) + ii1 * ii2)
+                      / (np.maximum(count, 2) - 1) / den)
+    fsc[~np.isfinite(fsc)] = 0
+    std[~np.isfinite(std) | (std == 0)] = 1
+    std *= np.sqrt(numAsymUnits)
+
+    qValues = fdrControlRows(norm.sf(fsc[:, 1:] / std[:, 1:]), level)
+    return getResolutionRows(qValues, windowSize, apix, level)
+
+
+def scanWindowsBatched(half1, half2, centers, windowSize, apix, numAsymUnits=1,
+                       level=FDR_LEVEL, evaluate=None, batchSize=BATCH_SIZE,
+                       workers=1):
+    """ Same as scanWindows, but the windows are cut from the maps in stacks
+    of batchSize, transformed with one scipy.fft call (using workers threads)
+    and their resolutions computed together by batchWindowResolutions. """
+    halfWindow = windowSize // 2
+    taper = np.hanning(windowSize)
+    taper = taper[:, None, None] * taper[None, :, None] * taper[None, None, :]
+    taper = taper.astype(half1.dtype)
+    offsets = getBatchShellOffsets(windowSize, batchSize)
+    views = [np.lib.stride_tricks.sliding_window_view(half, (windowSize,) * 3)
+             for half in (half1, half2)]
+
+    coarse = np.full([len(c) for c in centers], OUTSIDE_MASK, dtype=half1.dtype)
+    indices = np.argwhere(np.ones(coarse.shape, dtype=bool) if evaluate is None
+                          else evaluate)
+    for start in range(0, len(indices), batchSize):
+        batch = indices[start:start + batchSize]
+        corners = tuple(c[batch[:, axis]] - halfWindow for axis, c in enumerate(centers))
+        f1, f2 = [fft.rfftn(view[corners] * taper, axes=(1, 2, 3),
+                            workers=workers).reshape(len(batch), -1)
+                  for view in views]
+        coarse[tuple(batch.T)] = batchWindowResolutions(f1, f2, offsets, windowSize,
+                                                        apix, numAsymUnits, level)
+    return coarse
+
+
+def _getCenteredPoints(centers, shape):
+    # (x, y, z) coordinates of the window grid relative to the box center
+    zz, yy, xx = np.meshgrid(*centers, indexing='ij')
+    origin = np.array(shape[::-1]) // 2
+    return np.stack([xx.ravel(), yy.ravel(), zz.ravel()], axis=1) - origin
+
+
+def _getSymmetryOperators(points, matrices, chunkSize=2 ** 16):
+    # Index of the operator R of each point such that R^T p is in the
+    # asymmetric unit (the Dirichlet domain of SYMMETRY_REFERENCE)
+    orbit = matrices @ (SYMMETRY_REFERENCE / np.linalg.norm(SYMMETRY_REFERENCE))
+    return np.concatenate([np.argmax(points[i:i + chunkSize] @ orbit.T, axis=1)
+                           for i in range(0, len(points), chunkSize)])
+
+
+def getAsymmetricWindows(centers, shape, matrices):
+    """ Boolean grid of the windows centered in the asymmetric unit of the
+    point group given by matrices, dilated by one grid step so that the
+    asymmetric unit can be interpolated. """
+    gridShape = [len(c) for c in centers]
+    inUnit = _getSymmetryOperators(_getCenteredPoints(centers, shape), matrices) == 0
+    return ndimage.maximum_filter(inUnit.reshape(gridShape).astype(np.uint8),
+                                  size=3) > 0
+
+
+def symmetrizeGrid(grid, centers, shape, matrices, stepSize):
+    """ Replace each value of the window grid by the one interpolated at its
+    symmetry image in the asymmetric unit. """
+    points = _getCenteredPoints(centers, shape)
+    operators = _getSymmetryOperators(points, matrices)
+    images = np.empty(points.shape)
+    for i in range(0, len(points), 2 ** 16):
+        chunk = slice(i, i + 2 ** 16)
+        images[chunk] = np.einsum('nji,nj->ni', matrices[operators[chunk]], points[chunk])
+    origin = np.array(shape) // 2
+    coords = [(images[:, 2 - axis] + origin[axis] - c[0]) / float(stepSize)
+              for axis, c in enumerate(centers)]
+    values = ndimage.map_coordinates(grid, coords, order=1, mode='nearest')
+    return values.reshape(grid.shape).astype(grid.dtype)
+
+
+def getWindowCenters(shape, windowSize, stepSize, centered=False):
+    """ Centers along each axis of the windows that fit in the volume. If
+    centered, the grid goes through the box center (n // 2) and extends the
+    same number of steps on both sides, so that it is mapped onto itself by
+    the symmetry operators. """
+    halfWindow = windowSize // 2
+    centers = []
+    for n in shape:
+        first, last = halfWindow, n - windowSize + halfWindow
+        if centered:
+            steps = min(n // 2 - first, last - n // 2) // stepSize
+            first, last = n // 2 - steps * stepSize, n // 2 + steps * stepSize
+        centers.append(np.arange(first, last + 1, stepSize))
+    return centers
+
+
+def _getMaskWindows(mask, centers, stepSize):
+    # Windows centered inside the mask dilated by one step
+    if mask is None:
+        return None
+    dilated = ndimage.maximum_filter((mask > 0.5).astype(np.uint8),
+                                     size=2 * stepSize + 1)
+    return dilated[np.ix_(*centers)] > 0
+
+
+def _scanGrid(half1, half2, centers, windowSize, apix, numAsymUnits, level,
+              evaluate, numberOfWorkers, batchSize):
+    # Scan the windows with scanWindowsBatched or with scanWindows, in one
+    # slab along z per worker process
+    if batchSize > 0:
+        scan = partial(scanWindowsBatched, batchSize=batchSize, workers=1)
+    else:
+        scan = scanWindows
+    halfWindow = windowSize // 2
+    numberOfWorkers = min(numberOfWorkers, len(centers[0]))
+    if numberOfWorkers <= 1:
+        return scan(half1, half2, centers, windowSize, apix, numAsymUnits,
+                    level, evaluate)
+    futures = []
+    with ProcessPoolExecutor(max_workers=numberOfWorkers) as executor:
+        for chunk in np.array_split(np.arange(len(centers[0])), numberOfWorkers):
+            z0 = centers[0][chunk[0]] - halfWindow
+            z1 = centers[0][chunk[-1]] - halfWindow + windowSize
+            futures.append(executor.submit(scan, half1[z0:z1], half2[z0:z1],
+                                           [centers[0][chunk] - z0, centers[1], centers[2]],
+                                           windowSize, apix, numAsymUnits, level,
+                                           None if evaluate is None else evaluate[chunk]))
+        return np.concatenate([future.result() for future in futures])
+
+
+def _fillNotComputed(grid, evaluate):
+    # Windows not computed take the value of the nearest computed one,
+    # so they do not leak into the interpolation inside the mask
+    if evaluate is None or not evaluate.any() or evaluate.all():
+        return grid
+    indices = ndimage.distance_transform_edt(~evaluate, return_distances=False,
+                                             return_indices=True)
+    return grid[tuple(indices)]
+
+
+def localResolutions(half1, half2, apix, mask=None, windowSize=WINDOW_SIZE,
+                     stepSize=STEP_SIZE, lowRes=None, numAsymUnits=1,
+                     level=FDR_LEVEL, numberOfWorkers=1, restrictToMask=False,
+                     batchSize=0, sym=None):
+    """ Local FDR-FSC resolution map. Windows are evaluated on a grid with the
+    given step and the result is interpolated to every voxel. Voxels outside
+    the mask are set to OUTSIDE_MASK. With restrictToMask only the windows
+    centered inside the mask (dilated by one step, so that every voxel of the
+    mask can be interpolated) are computed. With several workers the grid is split in slabs
+    along z, each one scanned by a separate process on its part of the maps
+    (padded with half a window on each side). If batchSize is given, each
+    slab is scanned in batches by scanWindowsBatched. If a symmetry string is given, only the
+    windows of the asymmetric unit are computed and the rest of the grid is
+    filled by symmetry, on a window grid centered on the symmetry origin. """
+    shape = half1.shape
+    centers = getWindowCenters(shape, windowSize, stepSize, centered=sym is not None)
+    evaluate = _getMaskWindows(mask, centers, stepSize) if restrictToMask else None
+    matrices = None
+    if sym is not None:
+        matrices = getSymmetryMatrices(sym)
+        asymmetric = getAsymmetricWindows(centers, shape, matrices)
+        print('Symmetric scan: %d of %d windows in the asymmetric unit of %s'
+              % (asymmetric.sum(), asymmetric.size, sym.upper()), flush=True)
+        evaluate = asymmetric if evaluate is None else evaluate & asymmetric
+
+    coarse = _scanGrid(half1, half2, centers, windowSize, apix, numAsymUnits,
+                       level, evaluate, numberOfWorkers, batchSize)
+    coarse = _fillNotComputed(coarse, evaluate)
+    if matrices is not None:
+        coarse = symmetrizeGrid(coarse, centers, shape, matrices, stepSize)
+    return _getResolutionMap(coarse, centers, shape, stepSize, lowRes, mask)
+
+
+def adaptiveLocalResolutions(half1, half2, apix, mask=None, windowSize=WINDOW_SIZE,
+                             stepSize=STEP_SIZE, coarseFactor=COARSE_FACTOR,
+                             tolerance=REFINE_TOLERANCE, lowRes=None,
+                             numAsymUnits=1, level=FDR_LEVEL, numberOfWorkers=1,
+                             restrictToMask=False, batchSize=0):
+    """ Coarse to fine version of localResolutions. The windows are first
+    computed on a grid coarseFactor times sparser than the one given by
+    stepSize, which is interpolated to the fine grid. Then only the fine
+    windows of the coarse cells selected by getRefineWindows are computed. """
+    shape = half1.shape
+    centers = getWindowCenters(shape, windowSize, stepSize)
+    fineShape = tuple(len(c) for c in centers)
+    evaluate = _getMaskWindows(mask, centers, stepSize) if restrictToMask else None
+    if evaluate is None:
+        evaluate = np.ones(fineShape, dtype=bool)
+
+    # Coarse pass, on every coarseFactor-th window of the fine grid
+    coarseIndices = [np.arange(0, n, coarseFactor) for n in fineShape]
+    coarseCenters = [c[i] for c, i in zip(centers, coarseIndices)]
+    coarseEvaluate = evaluate[np.ix_(*coarseIndices)]
+    coarse = _scanGrid(half1, half2, coarseCenters, windowSize, apix, numAsymUnits,
+                       level, coarseEvaluate, numberOfWorkers, batchSize)
+    coarse = _fillNotComputed(coarse, coarseEvaluate)
+    fine = upsampleGrid(coarse, coarseIndices, fineShape, coarseFactor)
+
+    refine = getRefineWindows(coarse, fineShape, coarseFactor, windowSize * apix,
+                              tolerance)
+    refine &= evaluate
+    refine[np.ix_(*coarseIndices)] = False
+
+    if refine.any():
+        refined = _scanGrid(half1, half2, centers, windowSize, apix, numAsymUnits,
+                            level, refine, numberOfWorkers, batchSize)
+        fine[refine] = refined[refine]
+    print('Adaptive local resolution: %d coarse and %d refined windows out of %d'
+          % (coarseEvaluate.sum(), refine.sum(), evaluate.sum()), flush=True)
+    return _getResolutionMap(fine, centers, shape, stepSize, lowRes, mask)
+
+
+def _getCellRange(grid):
+    # Range of the values at the 8 corners of the cell between each node and
+    # the next ones along every axis
+    high, low = grid, grid
+    for axis, n in enumerate(grid.shape):
+        following = np.minimum(np.arange(n) + 1, n - 1)
+        high = np.maximum(high, np.take(high, following, axis=axis))
+        low = np.minimum(low, np.take(low, following, axis=axis))
+    return high - low
+
+
+def getRefineWindows(coarse, fineShape, coarseFactor, windowLength,
+                     tolerance=REFINE_TOLERANCE):
+    """ Boolean grid of the fine windows to compute by the adaptive scan: those
+    in the coarse cells whose corners differ by more than tolerance Fourier
+    shells of the window (of windowLength Angstrom). Comparing shells instead
+    of Angstrom makes the tolerance independent of the resolution, where one
+    shell is a few Angstrom at low resolution but a fraction of an Angstrom
+    at high resolution. """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        refineCells = _getCellRange(windowLength / coarse) > tolerance
+    # Each fine window lies in the coarse cell of its lower coarse neighbour
+    return refineCells[np.ix_(*[np.arange(n) // coarseFactor for n in fineShape])]
+
+
+def fourierCrop(volume, boxSize):
+    """ Downsample a cubic volume to boxSize by cropping its transform. """
+    n = volume.shape[0]
+    if boxSize >= n:
+        return volume
+    half = boxSize // 2
+    keep = np.r_[0:half, n - half:n]
+    f = fft.rfftn(volume)[np.ix_(keep, keep, np.arange(half + 1))]
+    return (fft.irfftn(f, (boxSize,) * 3) * (boxSize / n) ** 3).astype(volume.dtype)
+
+
+def getPreviewBoxSize(boxSize, apix, resolution, margin=PREVIEW_MARGIN):
+    """ Smallest even box whose Nyquist frequency is margin times beyond the
+    given resolution. """
+    newSize = int(np.ceil(2 * margin * boxSize * apix / resolution))
+    return min(newSize + newSize % 2, boxSize)
+
+
+def previewLocalResolutions(half1, half2, apix, resolution, mask=None,
+                            margin=PREVIEW_MARGIN, lowRes=None, **kwargs):
+    """ Quick estimate of the local resolution map: the half maps are Fourier
+    cropped to getPreviewBoxSize, scanned by localResolutions (with kwargs)
+    and the result is interpolated back to the original grid. The window and
+    step sizes are scaled to the cropped grid, so that the windows cover the
+    same physical volume as in the full scan (windows are at least
+    PREVIEW_MIN_WINDOW voxels). Return the map and the box size used. """
+    shape = half1.shape
+    boxSize = getPreviewBoxSize(shape[0], apix, resolution, margin)
+    if boxSize >= shape[0]:
+        return localResolutions(half1, half2, apix, mask=mask, lowRes=lowRes,
+                                **kwargs), shape[0]
+
+    scale = shape[0] / boxSize
+    windowSize = kwargs.pop('windowSize', WINDOW_SIZE)
+    stepSize = kwargs.pop('stepSize', STEP_SIZE)
+    kwargs['windowSize'] = max(int(round(windowSize / scale)), PREVIEW_MIN_WINDOW)
+    kwargs['stepSize'] = max(int(round(stepSize / scale)), 1)
+    smallMask = None
+    if mask is not None:
+        smallMask = ndimage.zoom((mask > 0.5).astype(np.float32), 1 / scale,
+                                 order=1, grid_mode=True, mode='grid-constant')
+    small = localResolutions(fourierCrop(half1, boxSize), fourierCrop(half2, boxSize),
+                             apix * scale, mask=smallMask, **kwargs)
+    small = _fillNotComputed(small, small != OUTSIDE_MASK)
+    # Centers of the cropped voxels in voxels of the original grid
+    centers = [(np.arange(m) + 0.5) * scale - 0.5 for m in small.shape]
+    return _getResolutionMap(small, centers, shape, scale, lowRes, mask), boxSize
+
+
+def _getResolutionMap(grid, centers, shape, stepSize, lowRes, mask):
+    # Full size local resolution map from the window grid
+    resMap = upsampleGrid(grid, centers, shape, stepSize)
+    if lowRes is not None and lowRes > 0:
+        np.minimum(resMap, lowRes, out=resMap)
+    if mask is not None:
+        resMap[mask < 0.5] = OUTSIDE_MASK
+    return resMap
+
+
+def upsampleGrid(coarse, centers, shape, stepSize):
+    """ Linear interpolation (separable along each axis) of the values computed
+    on the window centers to the full volume grid, in the precision of coarse. """
+    data = coarse
+    for axis, (n, c) in enumerate(zip(shape, centers)):
+        pos = np.clip((np.arange(n) - c[0]) / float(stepSize), 0, len(c) - 1)
+        low = np.minimum(np.floor(pos).astype(int), max(len(c) - 2, 0))
+        high = np.minimum(low + 1, len(c) - 1)
+        frac = (pos - low).astype(coarse.dtype).reshape([-1 if a == axis else 1
+                                                         for a in range(3)])
+        data = (np.take(data, low, axis=axis) * (1 - frac) +
+                np.take(data, high, axis=axis) * frac)
+    return data
+
+
+def analyzeHalfMaps(halfMap1, halfMap2, apix, outputDir, numAsymUnits=1,
+                    dtype=np.float64, shellCacheDir=None):
+    """ Global FDR-FSC of a pair of half map files. FSC.txt and FSC.pdf are
+    written to outputDir and the resolution is returned. Suitable as a task
+    for a process pool, where the shell indices are kept between tasks. """
+    setShellCacheDir(shellCacheDir)
+    result = globalFsc(readMap(halfMap1, dtype), readMap(halfMap2, dtype), apix,
+                       numAsymUnits=numAsymUnits)
+    writeFsc(outputDir, result)
+    return result.resolution
@@ -0,0 +1,57 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team (scipion@cnb.csic.es)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+
+
+import numpy as np
+
+from pwem.objects import FSC
+from pyworkflow.object import String
+
+
+class FdrFSC(FSC):
+    """ FSC curve thresholded by FDR control. The whole curve (frequencies,
+    FSC values and FDR threshold) is kept as a binary NPY file. The
+    frequencies and FSC values are also set as the lists of the base FSC, so
+    the code that reads them directly gets the same curve. """
+    def __init__(self, **kwargs):
+        FSC.__init__(self, **kwargs)
+        self._curveFile = String()
+
+    def setCurveFile(self, fileName):
+        self._curveFile.set(fileName)
+        frequencies, fsc, _ = self.getArrays()
+        self.setData(frequencies.tolist(), fsc.tolist())
+
+    def getCurveFile(self):
+        return self._curveFile.get()
+
+    def getArrays(self):
+        """ Return the frequency, FSC and threshold arrays (the threshold is
+        None when it is not available). """
+        curve = np.load(self.getCurveFile())
+        return curve[0], curve[1], curve[2] if len(curve) > 2 else None
+
+    def getThreshold(self):
+        return self.getArrays()[2]
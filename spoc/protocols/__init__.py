@@ -25,4 +25,7 @@
 # **************************************************************************
 
 from .protocol_fsc_fdr_control import ProtResolutionAnalysisFSCFDR
-from .protocol_confidence_map import ProtConfidenceMap
\ No newline at end of file
+from .protocol_confidence_map import ProtConfidenceMap
+from .protocol_fsc_fdr_control_batch import ProtResolutionAnalysisFSCFDRBatch
+from .protocol_confidence_map_batch import ProtConfidenceMapBatch
+from .protocol_confidence_map_threshold import ProtConfidenceMapThreshold
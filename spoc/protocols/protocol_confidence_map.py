@@ -27,20 +27,29 @@ import os.path
 from os.path import abspath
 import numpy as np
 
-from pwem.emlib.image import ImageHandler
 from pwem.objects import FSC, Volume
 from pwem.protocols import ProtAnalysis3D
 
-from pyworkflow.protocol import PointerParam, BooleanParam, FloatParam
+from pyworkflow.protocol import PointerParam, BooleanParam, FloatParam, \
+    IntParam, EnumParam, StringParam, LEVEL_ADVANCED
 from pyworkflow import BETA
 import pyworkflow.utils as pwutils
 
 import spoc
+import spoc.constants as spocConst
+import spoc.fdr as spocFdr
+from spoc.convert import (stageMap, getScratchPath, scratchFolder, retrieveOutputs,
+                          writeMapStatistics, loadMapStatistics, getMedian)
+import spoc.cache as spocCache
 
 INPUT_MAP = 'inputMap.mrc'
 OUTPUT_MAP = '_confidenceMap.mrc'
 OUTPUT_LOG10 = '_-log10FDR.mrc'
 FILTERED_MAP = '_locFilt.mrc'
+NOISE_REPORT = 'noise_boxes.txt'
+ZSCORES_FILE = '_zScores.npz'
+# Confidence values below this one are considered background
+CONFIDENCE_CUTOFF = 0.1
 
 class ProtConfidenceMap(ProtAnalysis3D):
     """
@@ -71,6 +80,62 @@ class ProtConfidenceMap(ProtAnalysis3D):
                           'noise estimation fall on top of the molecule, '
                           'you can specify the center of region of your '
                           'choice with -noiseBox x y z')
+        form.addParam('engine', EnumParam, default=spocConst.CONFIDENCE_ENGINE_SPOC,
+                      choices=['SPOC script', 'Chunked'],
+                      display=EnumParam.DISPLAY_HLIST,
+                      label='Confidence map engine',
+                      help='SPOC script: run FDRcontrol.py, which keeps several '
+                           'full size copies of the map in memory.\n'
+                           'Chunked: memory map the input and process it in slabs '
+                           'of z slices, so that the peak memory is a small multiple '
+                           'of one slab. The Benjamini-Yekutieli adjustment is done '
+                           'from a streamed histogram of the voxel z-scores. Use it '
+                           'for very large boxes. Local resolution filtering is not '
+                           'available with this engine.')
+        form.addParam('slabSize', IntParam, default=spocFdr.SLAB_SIZE,
+                      condition='engine==%d' % spocConst.CONFIDENCE_ENGINE_CHUNKED,
+                      expertLevel=LEVEL_ADVANCED,
+                      label='Slices per slab',
+                      help='Number of z slices of the map processed at once.')
+        form.addParam('noiseBoxes', StringParam, default='',
+                      condition='engine==%d' % spocConst.CONFIDENCE_ENGINE_CHUNKED,
+                      label='Candidate noise box centers',
+                      help='Optional list of noise box centers in voxels, as '
+                           '"x y z; x y z; ...", with the size given above. The '
+                           'statistics of all of them are gathered in one pass over '
+                           'the map and the boxes that seem to overlap signal (with '
+                           'a clearly higher mean or deviation than the median box) '
+                           'are reported in %s. The confidence map is then computed '
+                           'with the noise model selected below.' % NOISE_REPORT)
+        form.addParam('noiseModel', EnumParam, default=spocFdr.MODEL_POOLED,
+                      condition='engine==%d' % spocConst.CONFIDENCE_ENGINE_CHUNKED,
+                      choices=['Pooled', 'Best box'],
+                      display=EnumParam.DISPLAY_HLIST,
+                      label='Noise model',
+                      help='Pooled: statistics of all the candidate boxes that do '
+                           'not overlap signal.\n'
+                           'Best box: the candidate box with the lowest standard '
+                           'deviation.')
+        form.addParam('savePValues', BooleanParam, default=True,
+                      condition='engine==%d' % spocConst.CONFIDENCE_ENGINE_CHUNKED,
+                      label='Keep the z-score map?',
+                      help='Store the voxel z-scores (float32, compressed) in the '
+                           'extra folder, from which the p-values are computed again '
+                           'in double precision, so that the confidence maps can be '
+                           'computed again with another FDR/FWER method or level '
+                           'by the "confidence map re-threshold" protocol without '
+                           'rerunning this one.')
+        form.addParam('precision', EnumParam, default=spocConst.PRECISION_FLOAT64,
+                      choices=['float32', 'float64'],
+                      display=EnumParam.DISPLAY_HLIST,
+                      condition='engine==%d' % spocConst.CONFIDENCE_ENGINE_CHUNKED,
+                      expertLevel=LEVEL_ADVANCED,
+                      label='Precision',
+                      help='Floating point precision of the maps and of the '
+                           'arrays computed from them. float32 halves the memory '
+                           'and I/O of the computation; the noise statistics, histogram and p-values are still '
+                           'accumulated in float64. The output maps are always '
+                           'written as float32.')
         form.addParam('locResFilter', BooleanParam,
                       default=True,
                       label="Filter the map with local resolution?",
@@ -89,8 +154,32 @@ class ProtConfidenceMap(ProtAnalysis3D):
                            ' image and the Confidence Map. Adjustment of the noise'
                            ' estimation region can be done accordingly and is '
                            'important for accurate background noise estimation.')
-
-
+        form.addParam('inProcess', BooleanParam, default=True,
+                      label='Run SPOC in-process?',
+                      expertLevel=LEVEL_ADVANCED,
+                      condition='engine==%d' % spocConst.CONFIDENCE_ENGINE_SPOC,
+                      help='Run FDRcontrol.py inside the protocol process instead '
+                           'of launching a new Python interpreter. If SPOC can not '
+                           'be imported in the Scipion environment, a separate '
+                           'process will be used anyway.')
+        form.addParam('useScratch', BooleanParam, default=False,
+                      label='Use scratch folder?',
+                      expertLevel=LEVEL_ADVANCED,
+                      help='Stage the input map and run SPOC in the folder given '
+                           'by the SPOCSCRATCHDIR variable (%s), e.g. a node local '
+                           'disk, and copy back only the final outputs to the '
+                           'extra folder. The scratch files are removed when the '
+                           'computation finishes or fails.' % spoc.SCRATCHDIR)
+        form.addParam('useCache', BooleanParam, default=False,
+                      label='Reuse cached results?',
+                      expertLevel=LEVEL_ADVANCED,
+                      help='Look up the results in the cache folder given by the '
+                           'SPOCCACHEDIR variable (%s) before computing them. The '
+                           'cache key is made from the content of the input maps '
+                           'and the parameters, so a run with the same inputs '
+                           'just links the stored results. New results are added '
+                           'to the cache, which is limited to SPOCCACHESIZE GB.'
+                           % spoc.CACHEDIR)
 
     # --------------------------- INSERT steps functions ------------------------
     def _insertAllSteps(self):
@@ -100,15 +189,66 @@ class ProtConfidenceMap(ProtAnalysis3D):
 
     # --------------------------- STEPS functions -------------------------------
     def convertInputStep(self):
-        ih = ImageHandler()
-        file_map = self.inputMap.get().getFileName()
-        if pwutils.getExt(file_map) == '.mrc':
-            file_map += ':mrc'
-        ih.convert(file_map, self._getTmpPath(INPUT_MAP))
-
+        pwutils.makePath(os.path.dirname(self._getStagedPath(INPUT_MAP)))
+        stageMap(self.inputMap.get().getFileName(), self._getStagedPath(INPUT_MAP),
+                 self.inputMap.get().getSamplingRate())
 
     def computeConfidenceMapStep(self):
-        path_inputMap = os.path.abspath(self._getTmpPath(INPUT_MAP))
+        cacheKey = self._getCacheKey() if self.useCache.get() else None
+        if cacheKey and spocCache.retrieve(cacheKey, self._getExtraPath()):
+            return
+
+        with scratchFolder(self, self.useScratch.get()):
+            if not os.path.exists(self._getStagedPath(INPUT_MAP)):
+                # The scratch folder is removed after a failure
+                self.convertInputStep()
+            if self.useScratch.get():
+                scratchDir = getScratchPath(self, 'extra')
+                pwutils.makePath(scratchDir)
+                self.computeConfidenceMap(scratchDir)
+                retrieveOutputs(scratchDir, self._getExtraPath())
+            else:
+                self.computeConfidenceMap(self._getExtraPath())
+
+        if cacheKey:
+            spocCache.store(cacheKey, self._getExtraPath())
+
+    def computeConfidenceMap(self, cwd):
+        if self.engine.get() == spocConst.CONFIDENCE_ENGINE_CHUNKED:
+            self.computeChunked(cwd)
+        else:
+            self.runFdrControl(cwd)
+
+    def computeChunked(self, cwd):
+        fnbase = pwutils.removeBaseExt(INPUT_MAP)
+        center, noise = None, None
+        boxSize = self.box.get() if self.box.hasValue() else None
+        if self.noiseBoxes.get():
+            centers = spocFdr.parseNoiseBoxes(self.noiseBoxes.get())
+            mean, std, stats, used = spocFdr.evaluateNoiseBoxes(
+                self._getStagedPath(INPUT_MAP), centers, boxSize,
+                self.noiseModel.get(), self.slabSize.get())
+            reportFile = os.path.join(cwd, NOISE_REPORT)
+            spocFdr.writeNoiseReport(reportFile, centers, stats, used)
+            with open(reportFile) as f:
+                print("Candidate noise boxes:\n%s" % f.read(), flush=True)
+            noise = (mean, std)
+        elif self.box.hasValue() and self.x_center.hasValue() and \
+                self.y_center.hasValue() and self.z_center.hasValue():
+            center = (self.x_center.get(), self.y_center.get(), self.z_center.get())
+        mean, std = spocFdr.confidenceMap(
+            self._getStagedPath(INPUT_MAP),
+            os.path.join(cwd, fnbase + OUTPUT_MAP),
+            os.path.join(cwd, fnbase + pwutils.removeBaseExt(OUTPUT_MAP) + OUTPUT_LOG10),
+            self.inputMap.get().getSamplingRate(),
+            boxSize=boxSize, center=center, slabSize=self.slabSize.get(),
+            dtype=self.getPrecision(), noise=noise,
+            zScoresFile=(os.path.join(cwd, fnbase + ZSCORES_FILE)
+                         if self.savePValues.get() else None))
+        print("Background noise: mean %f, standard deviation %f" % (mean, std))
+
+    def runFdrControl(self, cwd):
+        path_inputMap = os.path.abspath(self._getStagedPath(INPUT_MAP))
         args = ' -em %s ' % path_inputMap
         args += ' -p %f ' % self.inputMap.get().getSamplingRate()
         if self.box.hasValue():
@@ -120,8 +260,8 @@ class ProtConfidenceMap(ProtAnalysis3D):
         if self.locResFilter:
             args += ' -locResMap %s ' % os.path.abspath(self.resMap.get().getFileName())
 
-        program = spoc.Plugin.getProgram("FDRcontrol.py")
-        self.runJob(program, args, cwd=self._getExtraPath())
+        spoc.Plugin.runSpoc(self, "FDRcontrol.py", args,
+                            cwd=cwd, inProcess=self.inProcess.get())
 
     def createOutputStep(self):
 
@@ -129,6 +269,7 @@ class ProtConfidenceMap(ProtAnalysis3D):
         fnbase = pwutils.removeBaseExt(INPUT_MAP)
         confMap.setFileName(self._getExtraPath(fnbase+OUTPUT_MAP))
         confMap.setSamplingRate(self.inputMap.get().getSamplingRate())
+        writeMapStatistics(confMap.getFileName(), minValue=CONFIDENCE_CUTOFF)
         self._defineOutputs(confidenceMap=confMap)
         self._defineSourceRelation(self.inputMap, confMap)
 
@@ -148,6 +289,51 @@ class ProtConfidenceMap(ProtAnalysis3D):
             self._defineOutputs(localfiltMap=filtMap)
             self._defineSourceRelation(self.inputMap, filtMap)
 
+    # --------------------------- UTILS functions -----------------------------
+    def _getCacheKey(self):
+        files = [self.inputMap.get().getFileName()]
+        if self.locResFilter:
+            files.append(self.resMap.get().getFileName())
+        return spocCache.getCacheKey(files, program='FDRcontrol',
+                                     engine=self.engine.get(),
+                                     precision=self.getPrecision(),
+                                     noiseBoxes=self.getNoiseBoxes(),
+                                     noiseModel=self.noiseModel.get(),
+                                     savePValues=self.hasPValues(),
+                                     apix=self.inputMap.get().getSamplingRate(),
+                                     box=self.box.get(),
+                                     noiseBox=(self.x_center.get(), self.y_center.get(),
+                                               self.z_center.get()),
+                                     locResFilter=bool(self.locResFilter))
+
+    def hasPValues(self):
+        return (self.engine.get() == spocConst.CONFIDENCE_ENGINE_CHUNKED and
+                self.savePValues.get())
+
+    def getZScoresFile(self):
+        """ File with the voxel z-scores kept by the chunked engine, from which
+        the voxel p-values are computed again. """
+        return self._getExtraPath(pwutils.removeBaseExt(INPUT_MAP) + ZSCORES_FILE)
+
+    def getNoiseBoxes(self):
+        """ Candidate noise box centers, only used by the chunked engine. """
+        if self.engine.get() != spocConst.CONFIDENCE_ENGINE_CHUNKED:
+            return []
+        return spocFdr.parseNoiseBoxes(self.noiseBoxes.get() or '')
+
+    def getPrecision(self):
+        """ NumPy dtype of the chunked engine slabs. """
+        if self.engine.get() != spocConst.CONFIDENCE_ENGINE_CHUNKED:
+            return spocConst.PRECISION_DTYPES[spocConst.PRECISION_FLOAT64]
+        return spocConst.PRECISION_DTYPES[self.precision.get()]
+
+    def _getStagedPath(self, *paths):
+        """ Location of the staged input map: the node local scratch folder
+        (SPOCSCRATCHDIR) or the protocol tmp folder. """
+        if self.useScratch.get():
+            return getScratchPath(self, 'tmp', *paths)
+        return self._getTmpPath(*paths)
+
     # --------------------------- INFO functions ------------------------------
     def _methods(self):
         methods = []
@@ -160,10 +346,29 @@ class ProtConfidenceMap(ProtAnalysis3D):
             summary.append("Confidence map not ready yet.")
         else:
             summary.append("Confidence map estimated")
+            if os.path.exists(self._getExtraPath(NOISE_REPORT)):
+                with open(self._getExtraPath(NOISE_REPORT)) as f:
+                    rows = f.readlines()[1:]
+                summary.append("Noise model from %d of %d candidate boxes, %d of "
+                               "them overlap signal"
+                               % (sum('used' in row for row in rows), len(rows),
+                                  sum('signal' in row for row in rows)))
+            stats = loadMapStatistics(self.confidenceMap.getFileName())
+            if stats is not None:
+                summary.append("Median confidence above %.1f: %.3f"
+                               % (CONFIDENCE_CUTOFF, getMedian(stats)))
+        return summary
 
     def _validate(self):
         errors = []
         if not self.inputMap.get():
             errors.append("You must provide an input map")
+        if self.engine.get() == spocConst.CONFIDENCE_ENGINE_CHUNKED and self.locResFilter.get():
+            errors.append("Local resolution filtering is not available with the "
+                          "chunked engine")
+        try:
+            self.getNoiseBoxes()
+        except ValueError as e:
+            errors.append(str(e))
 
         return errors
@@ -0,0 +1,151 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team (scipion@cnb.csic.es)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import os.path
+
+from pwem.objects import Volume
+from pwem.protocols import ProtAnalysis3D
+
+from pyworkflow.protocol import PointerParam, FloatParam, STEPS_PARALLEL
+from pyworkflow import BETA
+import pyworkflow.utils as pwutils
+
+import spoc
+from spoc.convert import stageMap
+from spoc.protocols.protocol_confidence_map import (INPUT_MAP, OUTPUT_MAP,
+                                                    OUTPUT_LOG10)
+
+
+class ProtConfidenceMapBatch(ProtAnalysis3D):
+    """
+    Confidence maps of all the volumes of a set with the same noise model settings
+    """
+    _label = 'batch confidence maps'
+    _devStatus = BETA
+    stepsExecutionMode = STEPS_PARALLEL
+
+    # --------------------------- DEFINE param functions ------------------------
+    def _defineParams(self, form):
+        form.addSection(label='Input')
+        form.addParam('inputVolumes', PointerParam, pointerClass='SetOfVolumes',
+                      label="Input Volumes", important=True,
+                      help='Select a set of volumes for determining their '
+                           'confidence maps.')
+        line = form.addLine('Center of the noise box',
+                            help='If the default regions for noise estimation fall '
+                                 'on top of the molecules, you can specify the center '
+                                 'of the region of your choice. The same region is '
+                                 'used for all the volumes.')
+        line.addParam('x_center', FloatParam, allowsNull=True, label='x')
+        line.addParam('y_center', FloatParam, allowsNull=True, label='y')
+        line.addParam('z_center', FloatParam, allowsNull=True, label='z')
+        form.addParam('box', FloatParam, allowsNull=True,
+                      label="Size of the noise box",
+                      help='Size of the noise estimation region, used for all '
+                           'the volumes.')
+
+        form.addParallelSection(threads=4, mpi=0)
+
+    # --------------------------- INSERT steps functions ------------------------
+    def _insertAllSteps(self):
+        # One independent chain of steps per volume, executed in parallel
+        # according to the number of threads
+        computeIds = []
+        for volume in self.inputVolumes.get().iterItems():
+            volId = volume.getObjId()
+            convertId = self._insertFunctionStep(self.convertInputStep, volId,
+                                                 volume.getFileName(),
+                                                 prerequisites=[])
+            computeIds.append(self._insertFunctionStep(self.computeConfidenceMapStep,
+                                                       volId, prerequisites=[convertId]))
+        self._insertFunctionStep(self.createOutputStep, prerequisites=computeIds)
+
+    # --------------------------- STEPS functions -------------------------------
+    def convertInputStep(self, volId, fileName):
+        pwutils.makePath(self._getTmpPath(self._getVolDir(volId)))
+        stageMap(fileName, self._getInputMapPath(volId),
+                 self.inputVolumes.get().getSamplingRate())
+
+    def computeConfidenceMapStep(self, volId):
+        outputDir = self._getExtraPath(self._getVolDir(volId))
+        pwutils.makePath(outputDir)
+        args = ' -em %s ' % os.path.abspath(self._getInputMapPath(volId))
+        args += ' -p %f ' % self.inputVolumes.get().getSamplingRate()
+        if self.box.hasValue():
+            args += ' -w %i' % self.box.get()
+            if self.x_center.hasValue() and self.y_center.hasValue() \
+                    and self.z_center.hasValue():
+                args += ' -noiseBox %i %i %i' % (self.x_center.get(), self.y_center.get(),
+                                                 self.z_center.get())
+
+        # Separate processes, so several volumes can be processed at the same time
+        spoc.Plugin.runSpoc(self, "FDRcontrol.py", args, cwd=outputDir,
+                            inProcess=False)
+
+    def createOutputStep(self):
+        inputVolumes = self.inputVolumes.get()
+        samplingRate = inputVolumes.getSamplingRate()
+        confMaps = self._createSetOfVolumes(suffix='Confidence')
+        confMapsLog = self._createSetOfVolumes(suffix='Log10FDR')
+        confMaps.setSamplingRate(samplingRate)
+        confMapsLog.setSamplingRate(samplingRate)
+
+        fnbase = pwutils.removeBaseExt(INPUT_MAP)
+        fnbaseout = pwutils.removeBaseExt(OUTPUT_MAP) + OUTPUT_LOG10
+        for volume in inputVolumes.iterItems():
+            volDir = self._getVolDir(volume.getObjId())
+            for outputSet, suffix in [(confMaps, OUTPUT_MAP),
+                                      (confMapsLog, fnbaseout)]:
+                confMap = Volume()
+                confMap.setObjId(volume.getObjId())
+                confMap.setFileName(self._getExtraPath(volDir, fnbase + suffix))
+                confMap.setSamplingRate(samplingRate)
+                outputSet.append(confMap)
+
+        self._defineOutputs(confidenceMaps=confMaps,
+                            confidenceMaps_log10FDR=confMapsLog)
+        self._defineSourceRelation(self.inputVolumes, confMaps)
+        self._defineSourceRelation(self.inputVolumes, confMapsLog)
+
+    # --------------------------- UTILS functions -----------------------------
+    def _getVolDir(self, volId):
+        return 'volume_%06d' % volId
+
+    def _getInputMapPath(self, volId):
+        return self._getTmpPath(self._getVolDir(volId), INPUT_MAP)
+
+    # --------------------------- INFO functions ------------------------------
+    def _methods(self):
+        methods = []
+        methods.append('Confidence Map estimation for a set of volumes')
+        return methods
+
+    def _summary(self):
+        summary = []
+        if not self.isFinished():
+            summary.append("Confidence maps not ready yet.")
+        else:
+            summary.append("Confidence maps estimated for %d volumes"
+                           % self.inputVolumes.get().getSize())
+        return summary
@@ -0,0 +1,145 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team (scipion@cnb.csic.es)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+
+
+import os.path
+
+from pwem.objects import Volume
+from pwem.protocols import ProtAnalysis3D
+
+from pyworkflow.protocol import PointerParam, FloatParam, IntParam, EnumParam, \
+    LEVEL_ADVANCED
+from pyworkflow import BETA
+import pyworkflow.utils as pwutils
+
+import spoc.fdr as spocFdr
+from spoc.convert import writeMapStatistics, loadMapStatistics, getMedian
+from spoc.protocols.protocol_confidence_map import (CONFIDENCE_CUTOFF, OUTPUT_MAP,
+                                                    OUTPUT_LOG10)
+
+METHODS = [spocFdr.METHOD_BY, spocFdr.METHOD_BH, spocFdr.METHOD_BONFERRONI]
+OUTPUT_BASE = 'rethreshold'
+OUTPUT_MASK = '_mask.mrc'
+
+
+class ProtConfidenceMapThreshold(ProtAnalysis3D):
+    """
+    Recompute the confidence maps of a previous confidence map run with
+    another multiple testing correction or FDR level, from its stored z-scores
+    """
+    _label = 'confidence map re-threshold'
+    _devStatus = BETA
+
+    # --------------------------- DEFINE param functions ------------------------
+    def _defineParams(self, form):
+        form.addSection(label='Input')
+        form.addParam('inputProtocol', PointerParam, pointerClass='ProtConfidenceMap',
+                      label='Confidence map run', important=True,
+                      help='Run of the confidence maps protocol with the chunked '
+                           'engine and the z-score map kept.')
+        form.addParam('method', EnumParam, default=0,
+                      choices=['Benjamini-Yekutieli (FDR)', 'Benjamini-Hochberg (FDR)',
+                               'Bonferroni (FWER)'],
+                      label='Correction method',
+                      help='Multiple testing correction of the voxel p-values. '
+                           'Benjamini-Yekutieli is the one used by the confidence '
+                           'maps protocol.')
+        form.addParam('fdrLevel', FloatParam, default=spocFdr.FDR_LEVEL,
+                      label='FDR/FWER level',
+                      help='Voxels with an adjusted p-value up to this level are '
+                           'included in the output mask.')
+        form.addParam('slabSize', IntParam, default=spocFdr.SLAB_SIZE,
+                      expertLevel=LEVEL_ADVANCED,
+                      label='Slices per slab',
+                      help='Number of z slices of the z-score map processed at once.')
+
+    # --------------------------- INSERT steps functions ------------------------
+    def _insertAllSteps(self):
+        self._insertFunctionStep(self.rethresholdStep)
+        self._insertFunctionStep(self.createOutputStep)
+
+    # --------------------------- STEPS functions -------------------------------
+    def rethresholdStep(self):
+        spocFdr.rethreshold(self.inputProtocol.get().getZScoresFile(),
+                            self._getOutputFile(OUTPUT_MAP),
+                            self._getOutputFile(OUTPUT_LOG10),
+                            self.getSamplingRate(), method=METHODS[self.method.get()],
+                            slabSize=self.slabSize.get(),
+                            maskFile=self._getOutputFile(OUTPUT_MASK),
+                            fdrLevel=self.fdrLevel.get())
+
+    def createOutputStep(self):
+        inputMap = self.inputProtocol.get().inputMap
+
+        confMap = self._createVolume(OUTPUT_MAP)
+        writeMapStatistics(confMap.getFileName(), minValue=CONFIDENCE_CUTOFF)
+        self._defineOutputs(confidenceMap=confMap)
+        self._defineSourceRelation(inputMap, confMap)
+
+        confMaplog = self._createVolume(OUTPUT_LOG10)
+        self._defineOutputs(confidenceMap_log10FDR=confMaplog)
+        self._defineSourceRelation(inputMap, confMaplog)
+
+        confMask = self._createVolume(OUTPUT_MASK)
+        self._defineOutputs(confidenceMask=confMask)
+        self._defineSourceRelation(inputMap, confMask)
+
+    # --------------------------- UTILS functions -----------------------------
+    def _getOutputFile(self, suffix):
+        # Same names as the confidence maps protocol outputs
+        if suffix == OUTPUT_MAP:
+            return self._getExtraPath(OUTPUT_BASE + OUTPUT_MAP)
+        return self._getExtraPath(OUTPUT_BASE + pwutils.removeBaseExt(OUTPUT_MAP) + suffix)
+
+    def _createVolume(self, suffix):
+        volume = Volume()
+        volume.setFileName(self._getOutputFile(suffix))
+        volume.setSamplingRate(self.getSamplingRate())
+        return volume
+
+    def getSamplingRate(self):
+        return self.inputProtocol.get().inputMap.get().getSamplingRate()
+
+    # --------------------------- INFO functions ------------------------------
+    def _summary(self):
+        summary = []
+        if not self.isFinished():
+            summary.append("Confidence map not ready yet.")
+        else:
+            summary.append("Confidence map recomputed with %s, mask at level %g"
+                           % (self.getEnumText('method'), self.fdrLevel.get()))
+            stats = loadMapStatistics(self.confidenceMap.getFileName())
+            if stats is not None:
+                summary.append("Median confidence above %.1f: %.3f"
+                               % (CONFIDENCE_CUTOFF, getMedian(stats)))
+        return summary
+
+    def _validate(self):
+        errors = []
+        prot = self.inputProtocol.get()
+        if prot is not None and not os.path.exists(prot.getZScoresFile()):
+            errors.append("The selected run has no z-score map, run it with the "
+                          "chunked engine and the z-score map kept")
+        return errors
@@ -23,20 +23,30 @@
 # *  e-mail address 'scipion@cnb.csic.es'
 # *
 # **************************************************************************
+import json
 import os.path
 from os.path import abspath
-import numpy as np
 
 from pwem.emlib.image import ImageHandler
-from pwem.objects import FSC, Volume
+from pwem.objects import Volume
 from pwem.protocols import ProtAnalysis3D
 
 from pyworkflow.protocol import PointerParam, BooleanParam, FloatParam, \
-    IntParam, StringParam, LEVEL_ADVANCED
+    IntParam, StringParam, EnumParam, LEVEL_ADVANCED, STEPS_PARALLEL
+from pyworkflow.object import Float
 from pyworkflow import BETA
 import pyworkflow.utils as pwutils
 
 import spoc
+import spoc.constants as spocConst
+import spoc.fsc as spocFsc
+import spoc.cache as spocCache
+from spoc.objects import FdrFSC
+from spoc.convert import (stageMap, getScratchPath, scratchFolder, retrieveOutputs,
+                          writeMapStatistics, loadMapStatistics, getMedian,
+                          parseResolution)
+
+RESULTS_FILE = 'results.json'
 
 
 class ProtResolutionAnalysisFSCFDR(ProtAnalysis3D):
@@ -45,6 +55,11 @@ class ProtResolutionAnalysisFSCFDR(ProtAnalysis3D):
     """
     _label = 'resolution Analysis'
     _devStatus = BETA
+    stepsExecutionMode = STEPS_PARALLEL
+
+    def __init__(self, **args):
+        ProtAnalysis3D.__init__(self, **args)
+        self.globalResolution = Float()
 
     # --------------------------- DEFINE param functions ------------------------
     def _defineParams(self, form):
@@ -82,56 +97,220 @@ class ProtResolutionAnalysisFSCFDR(ProtAnalysis3D):
                       help='Number of asymmetric units for correction of symmetry effects. '
                            'If set to -1, this parameter will not be used')
         form.addParam('bfactor', FloatParam, default=-1,
+                      condition='engine==%d' % spocConst.ENGINE_SPOC,
                       label='B-Factor',
                       expertLevel=LEVEL_ADVANCED,
                       help='B-Factor for sharpening of the map. '
                            'If set to -1, this parameter will not be used')
+        form.addParam('engine', EnumParam, default=spocConst.ENGINE_SPOC,
+                      choices=['SPOC scripts', 'Single pass'],
+                      display=EnumParam.DISPLAY_HLIST,
+                      label='Resolution engine',
+                      help='SPOC scripts: run FSC_FDRcontrol.py once for the global '
+                           'FDR-FSC and, if requested, a second time for the local '
+                           'resolution.\n'
+                           'Single pass: load the half maps once and compute the '
+                           'global FDR-FSC curve (FSC.txt, FSC.pdf) and the local '
+                           'resolution map in the same run.')
+        form.addParam('restrictToMask', BooleanParam, default=True,
+                      condition='localRes and engine==%d' % spocConst.ENGINE_SINGLE_PASS,
+                      label='Scan only inside the mask?',
+                      help='When a mask is given, compute the local resolution only '
+                           'for the windows inside the mask. The voxels outside the '
+                           'mask are set to %d.' % spocFsc.OUTSIDE_MASK)
+        form.addParam('vectorizedNull', BooleanParam, default=True,
+                      condition='engine==%d' % spocConst.ENGINE_SINGLE_PASS,
+                      expertLevel=LEVEL_ADVANCED,
+                      label='Vectorized permutation test?',
+                      help='Draw one matrix of permutations shared by all the '
+                           'Fourier shells of the global FDR-FSC, and compute the '
+                           'permuted correlations of each shell with one array '
+                           'operation, instead of one permutation at a time. This '
+                           'is 2-3 times faster. Both use a fixed random seed, so '
+                           'the results are reproducible, and their thresholds only '
+                           'differ by the sampling of the permutations.')
+        form.addParam('preview', BooleanParam, default=False,
+                      condition='localRes and engine==%d' % spocConst.ENGINE_SINGLE_PASS,
+                      label='Fast preview?',
+                      help='Quick, approximate local resolution map. The half maps '
+                           'are Fourier cropped to a box whose Nyquist frequency is '
+                           '%.1f times beyond the global FDR-FSC resolution, the '
+                           'local scan is done on the smaller grid (with the window '
+                           'and step scaled to the same physical size) and the result '
+                           'is interpolated back to the original box. The output is '
+                           'labelled as a preview; run the protocol again without '
+                           'this option for the final map.' % spocFsc.PREVIEW_MARGIN)
+        form.addParam('symmetricScan', BooleanParam, default=False,
+                      condition='localRes and engine==%d' % spocConst.ENGINE_SINGLE_PASS,
+                      label='Scan only the asymmetric unit?',
+                      help='Compute the local resolution only for the windows in '
+                           'one asymmetric unit of the volume symmetry and fill the '
+                           'rest of the map by applying the symmetry operators. '
+                           'Supported symmetries: Cn and Dn (n-fold axis along z, '
+                           'two fold along x), T, O and I (I1, two fold axes along '
+                           'x, y and z) or I2. The map must be centered in the box '
+                           'and aligned to these axes.')
+        form.addParam('adaptive', BooleanParam, default=False,
+                      condition='localRes and not preview and engine==%d'
+                                % spocConst.ENGINE_SINGLE_PASS,
+                      label='Adaptive local resolution?',
+                      help='Scan first a grid of windows %d times sparser than the '
+                           'step, interpolate it and compute the windows at the '
+                           'full step only in the coarse cells whose corner '
+                           'estimates differ by more than the refinement tolerance. '
+                           'This gives maps close to the full step ones at a '
+                           'fraction of the cost.' % spocFsc.COARSE_FACTOR)
+        line = form.addLine('Adaptive scan',
+                            condition='localRes and adaptive and not preview and '
+                                      'engine==%d' % spocConst.ENGINE_SINGLE_PASS,
+                            expertLevel=LEVEL_ADVANCED,
+                            help='Spacing of the coarse grid, in steps, and the '
+                                 'difference between the corner estimates of a coarse '
+                                 'cell, in Fourier shells of the window, above which '
+                                 'its windows are computed at the full step.')
+        line.addParam('coarseFactor', IntParam, default=spocFsc.COARSE_FACTOR,
+                      label='Coarse factor')
+        line.addParam('refineTolerance', FloatParam, default=spocFsc.REFINE_TOLERANCE,
+                      label='Refinement tolerance (shells)')
+        form.addParam('batchSize', IntParam, default=spocFsc.BATCH_SIZE,
+                      condition='localRes and engine==%d' % spocConst.ENGINE_SINGLE_PASS,
+                      expertLevel=LEVEL_ADVANCED,
+                      label='Windows per FFT batch',
+                      help='Number of local windows cut from the half maps and '
+                           'transformed together in one FFT call, with the shell '
+                           'correlations of all of them computed in one vectorized '
+                           'pass. Set it to 0 to scan the windows one by one. In '
+                           'both cases the grid is split in slabs processed by the '
+                           'threads in parallel.')
+        form.addParam('precision', EnumParam, default=spocConst.PRECISION_FLOAT64,
+                      choices=['float32', 'float64'],
+                      display=EnumParam.DISPLAY_HLIST,
+                      condition='engine==%d' % spocConst.ENGINE_SINGLE_PASS,
+                      expertLevel=LEVEL_ADVANCED,
+                      label='Precision',
+                      help='Floating point precision of the maps and of the '
+                           'arrays computed from them. float32 halves the memory '
+                           'and I/O of the computation; the shell sums and p-values are still '
+                           'accumulated in float64. The output maps are always '
+                           'written as float32.')
+        form.addParam('inProcess', BooleanParam, default=True,
+                      label='Run SPOC in-process?',
+                      expertLevel=LEVEL_ADVANCED,
+                      condition='engine==%d' % spocConst.ENGINE_SPOC,
+                      help='Run the SPOC scripts inside the protocol process instead '
+                           'of launching a new Python interpreter for each of them. '
+                           'This avoids the interpreter startup and the import of '
+                           'the SPOC dependencies for every job. If SPOC can not be '
+                           'imported in the Scipion environment, a separate process '
+                           'will be used anyway.')
+
+        form.addParam('useScratch', BooleanParam, default=False,
+                      label='Use scratch folder?',
+                      expertLevel=LEVEL_ADVANCED,
+                      help='Stage the input maps and run SPOC in the folder given '
+                           'by the SPOCSCRATCHDIR variable (%s), e.g. a node local '
+                           'disk, and copy back only the final outputs to the '
+                           'extra folder. The scratch files are removed when the '
+                           'computation finishes or fails.' % spoc.SCRATCHDIR)
+
+        form.addParam('useCache', BooleanParam, default=False,
+                      label='Reuse cached results?',
+                      expertLevel=LEVEL_ADVANCED,
+                      help='Look up the results in the cache folder given by the '
+                           'SPOCCACHEDIR variable (%s) before computing them. The '
+                           'cache key is made from the content of the input maps '
+                           'and the parameters, so a run with the same inputs '
+                           'just links the stored results. New results are added '
+                           'to the cache, which is limited to SPOCCACHESIZE GB.'
+                           % spoc.CACHEDIR)
 
+        # The steps run in numberOfThreads - 1 threads, so by default the two
+        # half maps are converted at the same time. With the single pass
+        # engine the threads also split the local resolution scan in slabs
+        form.addParallelSection(threads=3, mpi=0)
 
     # --------------------------- INSERT steps functions ------------------------
     def _insertAllSteps(self):
-        self._insertFunctionStep(self.convertInputStep)
-        self._insertFunctionStep(self.computeControlStep)
-        self._insertFunctionStep(self.createOutputStep)
+        # Both half maps are converted in independent steps, so they run
+        # concurrently when more than one thread is used
+        convertIds = [self._insertFunctionStep(self.convertInputStep, fileName, stagedName,
+                                               prerequisites=[])
+                      for fileName, stagedName in zip(self.getHalfMapFiles(),
+                                                      ['halfone.mrc', 'halftwo.mrc'])]
+        computeId = self._insertFunctionStep(self.computeControlStep,
+                                             prerequisites=convertIds)
+        self._insertFunctionStep(self.createOutputStep, prerequisites=[computeId])
 
     # --------------------------- STEPS functions -------------------------------
-    def convertInputStep(self):
-        ih = ImageHandler()
-        if self.halfWhere.get():
-            file_halfOne, file_halfTwo = self.inputVol.get().getHalfMaps().split(",")
-        else:
-            file_halfOne = self.halfOne.get().getFileName()
-            file_halfTwo = self.halfTwo.get().getFileName()
-        if pwutils.getExt(file_halfOne) == '.mrc':
-            file_halfOne += ':mrc'
-        if pwutils.getExt(file_halfTwo) == '.mrc':
-            file_halfTwo += ':mrc'
-        ih.convert(file_halfOne, self._getTmpPath('halfone.mrc'))
-        ih.convert(file_halfTwo, self._getTmpPath('halftwo.mrc'))
+    def convertInputStep(self, fileName, stagedName):
+        pwutils.makePath(os.path.dirname(self._getStagedPath(stagedName)))
+        stageMap(fileName, self._getStagedPath(stagedName), self.getInputSamplingRate())
 
     def defineCommonArgs(self):
-        path_half_one = os.path.abspath(self._getTmpPath('halfone.mrc'))
-        path_half_two = os.path.abspath(self._getTmpPath('halftwo.mrc'))
+        path_half_one = os.path.abspath(self._getStagedPath('halfone.mrc'))
+        path_half_two = os.path.abspath(self._getStagedPath('halftwo.mrc'))
         args = '--halfmap1 %s --halfmap2 %s' \
                ' --symmetry %s' % (path_half_one, path_half_two, self.sym.get().upper())
 
-        if self.halfWhere.get():
-            args += " --apix %f " % self.inputVol.get().getSamplingRate()
-        else:
-            args += " --apix %f " % self.halfOne.get().getSamplingRate()
+        args += " --apix %f " % self.getInputSamplingRate()
 
         if self.bfactor.get() >= 0:
             args += ' --bFactor %f' % self.bfactor.get()
         return args
 
-    def estimateGlobalResolution(self, args):
-        program = spoc.Plugin.getProgram("FSC_FDRcontrol.py")
-        self.runJob(program, args, cwd=self._getExtraPath())
+    def estimateGlobalResolution(self, args, cwd):
+        spoc.Plugin.runSpoc(self, "FSC_FDRcontrol.py", args,
+                            cwd=cwd, inProcess=self.inProcess.get())
 
     def computeControlStep(self):
+        cacheKey = self._getCacheKey() if self.useCache.get() else None
+        if not (cacheKey and spocCache.retrieve(cacheKey, self._getExtraPath())):
+            self.writeResults(self.computeControl())
+            if cacheKey:
+                spocCache.store(cacheKey, self._getExtraPath())
+        elif not os.path.exists(self._getExtraPath(RESULTS_FILE)):
+            # Entries stored by previous versions only have the log line
+            self.writeResults(self._getSpocResolution())
+
+    def computeControl(self):
+        """ Compute the FDR-FSC results in the extra folder and return the
+        global resolution. """
+        with scratchFolder(self, self.useScratch.get()):
+            self._stageMissingInputs()
+            if self.engine.get() == spocConst.ENGINE_SINGLE_PASS:
+                return self.computeSinglePass()
+            elif self.useScratch.get():
+                scratchDir = getScratchPath(self, 'extra')
+                pwutils.makePath(scratchDir)
+                self.runSpocControl(scratchDir)
+                retrieveOutputs(scratchDir, self._getExtraPath())
+            else:
+                self.runSpocControl(self._getExtraPath())
+            return self._getSpocResolution()
+
+    def writeResults(self, resolution):
+        """ Store the global FDR-FSC results in extra/results.json, so they do
+        not have to be parsed from the log again. """
+        data = spocFsc.loadCurve(self._getExtraPath())
+        results = {'resolution': resolution,
+                   'fdrLevel': spocFsc.FDR_LEVEL,
+                   'engine': self.getEnumText('engine'),
+                   'precision': self.getPrecision(),
+                   'preview': self.isPreview(),
+                   'samplingRate': self.getInputSamplingRate(),
+                   'symmetry': self.sym.get(),
+                   'numAsymUnits': self.getNumAsymUnits(),
+                   'localResolution': self.localRes.get(),
+                   'frequencies': data[0].tolist(),
+                   'fsc': data[1].tolist(),
+                   'threshold': data[2].tolist() if len(data) > 2 else None,
+                   'date': pwutils.prettyTime()}
+        with open(self._getExtraPath(RESULTS_FILE), 'w') as f:
+            json.dump(results, f, indent=2)
 
+    def runSpocControl(self, cwd):
         args = self.defineCommonArgs()
-        self.estimateGlobalResolution(args)
+        self.estimateGlobalResolution(args, cwd)
 
         if self.localRes.get():
             args += ' -localResolutions'
@@ -148,13 +327,67 @@ class ProtResolutionAnalysisFSCFDR(ProtAnalysis3D):
             if self.mask.get():
                 args += ' --mask %s' % abspath(self.mask.get().getFileName())
 
-        program = spoc.Plugin.getProgram("FSC_FDRcontrol.py")
-        self.runJob(program, args, cwd=self._getExtraPath())
+            spoc.Plugin.runSpoc(self, "FSC_FDRcontrol.py", args,
+                                cwd=cwd, inProcess=self.inProcess.get())
+
+    def computeSinglePass(self):
+        apix = self.getInputSamplingRate()
+        spocFsc.setShellCacheDir(spoc.Plugin.getShellCachePath())
+        dtype = self.getPrecision()
+        half1 = spocFsc.readMap(self._getStagedPath('halfone.mrc'), dtype)
+        half2 = spocFsc.readMap(self._getStagedPath('halftwo.mrc'), dtype)
+        numAsymUnits = self.getNumAsymUnits()
+
+        result = spocFsc.globalFsc(half1, half2, apix, numAsymUnits=numAsymUnits,
+                                   vectorized=self.vectorizedNull.get())
+        spocFsc.writeFsc(self._getExtraPath(), result)
+        print('Resolution at 1 %% FDR-FSC: %.2f Angstrom' % result.resolution,
+              flush=True)
+
+        if self.localRes.get():
+            mask = None
+            if self.mask.get():
+                mask = ImageHandler().read(self.mask.get().getFileName()).getData()
+                if mask.shape != half1.shape:
+                    raise Exception("The mask (%s voxels) and the half maps (%s voxels) "
+                                    "have different sizes" % (mask.shape, half1.shape))
+            stepSize = self.stepSize.get()
+            kwargs = dict(mask=mask,
+                          stepSize=stepSize if stepSize > 0 else spocFsc.STEP_SIZE,
+                          lowRes=self.lowRes.get(), numAsymUnits=numAsymUnits,
+                          numberOfWorkers=self.numberOfThreads.get(),
+                          restrictToMask=self.restrictToMask.get(),
+                          batchSize=max(self.batchSize.get(), 0))
+            if self.symmetricScan.get():
+                kwargs['sym'] = self.sym.get()
+            if self.preview.get():
+                localRes, boxSize = spocFsc.previewLocalResolutions(
+                    half1, half2, apix, result.resolution, **kwargs)
+                print('PREVIEW: local resolution computed on half maps cropped '
+                      'from %d to %d voxels' % (half1.shape[0], boxSize), flush=True)
+            elif self.adaptive.get():
+                localRes = spocFsc.adaptiveLocalResolutions(
+                    half1, half2, apix, coarseFactor=max(self.coarseFactor.get(), 1),
+                    tolerance=self.refineTolerance.get(), **kwargs)
+            else:
+                localRes = spocFsc.localResolutions(half1, half2, apix, **kwargs)
+            spocFsc.writeMap(self._getExtraPath('halfone_localResolutions.mrc'),
+                             localRes, apix)
+        return result.resolution
 
     def createOutputStep(self):
+        with open(self._getExtraPath(RESULTS_FILE)) as f:
+            self.globalResolution.set(json.load(f)['resolution'])
+        self._store(self.globalResolution)
+
         if self.localRes.get():
             _volume = Volume()
             _volume.setFileName(self._getExtraPath("halfone_localResolutions.mrc"))
+            if self.isPreview():
+                _volume.setObjLabel('Local resolution (preview)')
+                _volume.setObjComment('Fast preview computed on Fourier cropped half '
+                                      'maps, not a final local resolution map')
+            writeMapStatistics(_volume.getFileName(), minValue=spocFsc.OUTSIDE_MASK)
             if self.halfWhere.get():
                 _volume.setSamplingRate(self.inputVol.get().getSamplingRate())
                 self._defineOutputs(outputLocalResMap=_volume)
@@ -165,9 +398,8 @@ class ProtResolutionAnalysisFSCFDR(ProtAnalysis3D):
                 self._defineSourceRelation(self.halfOne, _volume)
                 self._defineSourceRelation(self.halfTwo, _volume)
 
-        _fsc = FSC(objLabel='FSC')
-        data = np.loadtxt(self._getExtraPath('FSC.txt'))
-        _fsc.setData(data[0].tolist(), data[1].tolist())
+        _fsc = FdrFSC(objLabel='FSC')
+        _fsc.setCurveFile(self._getExtraPath(spocFsc.FSC_NPY))
         self._defineOutputs(outputFSC=_fsc)
         if self.halfWhere.get():
             self._defineSourceRelation(self.inputVol, _fsc)
@@ -175,12 +407,113 @@ class ProtResolutionAnalysisFSCFDR(ProtAnalysis3D):
             self._defineSourceRelation(self.halfOne, _fsc)
             self._defineSourceRelation(self.halfTwo, _fsc)
 
+    # --------------------------- UTILS functions -----------------------------
+    def _parseLogResolution(self):
+        """ Global resolution reported in the last 'Resolution at 1 % FDR-FSC'
+        line of the log, or None if there is none. """
+        logFile = self._getLogsPath('run.stdout')
+        return parseResolution(logFile) if os.path.exists(logFile) else None
+
+    def _getSpocResolution(self):
+        # FSC_FDRcontrol.py only reports the global resolution in its output
+        res = self._parseLogResolution()
+        if res is None:
+            raise Exception("The global resolution was not found in the output "
+                            "of FSC_FDRcontrol.py")
+        return res
+
+    def getGlobalResolution(self):
+        if self.globalResolution.hasValue():
+            return self.globalResolution.get()
+        # Runs from previous versions only have the resolution in the log
+        return self._parseLogResolution()
+
+    def _getStagedPath(self, *paths):
+        """ Location of the staged input maps: the node local scratch folder
+        (SPOCSCRATCHDIR) or the protocol tmp folder. """
+        if self.useScratch.get():
+            return getScratchPath(self, 'tmp', *paths)
+        return self._getTmpPath(*paths)
+
+    def _stageMissingInputs(self):
+        # The scratch folder is removed after a failure, so the inputs may
+        # have to be staged again when the protocol is continued
+        for fileName, stagedName in zip(self.getHalfMapFiles(),
+                                        ['halfone.mrc', 'halftwo.mrc']):
+            if not os.path.exists(self._getStagedPath(stagedName)):
+                self.convertInputStep(fileName, stagedName)
+
+    def _getCacheKey(self):
+        files = list(self.getHalfMapFiles())
+        if self.localRes.get() and self.mask.get():
+            files.append(self.mask.get().getFileName())
+        return spocCache.getCacheKey(files, program='FSC_FDRcontrol',
+                                     apix=self.getInputSamplingRate(),
+                                     sym=self.sym.get(),
+                                     numAsymUnits=self.numAsymUnits.get(),
+                                     bfactor=self.bfactor.get(),
+                                     localRes=self.localRes.get(),
+                                     lowRes=self.lowRes.get(),
+                                     stepSize=self.stepSize.get(),
+                                     engine=self.engine.get(),
+                                     precision=self.getPrecision(),
+                                     vectorizedNull=self.vectorizedNull.get(),
+                                     preview=self.isPreview(),
+                                     symmetricScan=self.symmetricScan.get(),
+                                     adaptive=self.adaptive.get(),
+                                     coarseFactor=self.coarseFactor.get(),
+                                     refineTolerance=self.refineTolerance.get(),
+                                     restrictToMask=self.restrictToMask.get())
+
+    def getHalfMapFiles(self):
+        if self.halfWhere.get():
+            return self.inputVol.get().getHalfMaps().split(",")
+        return self.halfOne.get().getFileName(), self.halfTwo.get().getFileName()
+
+    def isPreview(self):
+        return (self.localRes.get() and self.preview.get() and
+                self.engine.get() == spocConst.ENGINE_SINGLE_PASS)
+
+    def getPrecision(self):
+        """ NumPy dtype of the single pass engine arrays. """
+        if self.engine.get() != spocConst.ENGINE_SINGLE_PASS:
+            return spocConst.PRECISION_DTYPES[spocConst.PRECISION_FLOAT64]
+        return spocConst.PRECISION_DTYPES[self.precision.get()]
+
+    def getInputSamplingRate(self):
+        if self.halfWhere.get():
+            return self.inputVol.get().getSamplingRate()
+        return self.halfOne.get().getSamplingRate()
+
+    def getNumAsymUnits(self):
+        if self.numAsymUnits.get() > 0:
+            return self.numAsymUnits.get()
+        return spocFsc.getSymmetryOrder(self.sym.get())
+
     # --------------------------- INFO functions ------------------------------
     def _methods(self):
         methods = []
         methods.append('Significance analysis of FSC curves')
         return methods
 
+    def _validate(self):
+        errors = []
+        if (self.localRes.get() and self.mask.get()
+                and self.engine.get() == spocConst.ENGINE_SINGLE_PASS):
+            halfMap = self.inputVol.get() if self.halfWhere.get() else self.halfOne.get()
+            if halfMap is not None and self.mask.get().getDim() != halfMap.getDim():
+                errors.append("The mask and the half maps must have the same size")
+        if (self.localRes.get() and self.engine.get() == spocConst.ENGINE_SINGLE_PASS
+                and self.symmetricScan.get()):
+            if self.adaptive.get() and not self.preview.get():
+                errors.append("The asymmetric unit scan can not be combined with "
+                              "the adaptive local resolution")
+            try:
+                spocFsc.getSymmetryMatrices(self.sym.get())
+            except ValueError as e:
+                errors.append(str(e))
+        return errors
+
     def _summary(self):
         summary = []
         if not self.isFinished():
@@ -189,11 +522,15 @@ class ProtResolutionAnalysisFSCFDR(ProtAnalysis3D):
         if self.getOutputsSize() >= 1:
             if self.localRes.get():
                 summary.append("Local resolution computed from the half maps")
-            else:
-                stdout = self._getLogsPath('run.stdout')
-                with open(stdout) as file:
-                    for num, line in enumerate(file, 1):
-                        if 'Resolution at 1 % FDR-FSC' in line:
-                            res = [float(s) for s in line.split() if s.replace(".", "", 1).isdigit()][1]
-                summary.append('Resolution at 1 %% FDR-FSC: %.2f Angstrom' % res)
+                if self.isPreview():
+                    summary.append("PREVIEW: local resolution estimated on Fourier "
+                                   "cropped half maps, only a quick approximation")
+                stats = loadMapStatistics(self.outputLocalResMap.getFileName())
+                if stats is not None:
+                    summary.append("Median local resolution: %.2f Angstrom"
+                                   % getMedian(stats))
+            resolution = self.getGlobalResolution()
+            if resolution is not None:
+                summary.append('Resolution at 1 %% FDR-FSC: %.2f Angstrom'
+                               % resolution)
         return summary
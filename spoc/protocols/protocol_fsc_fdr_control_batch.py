@@ -0,0 +1,221 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team (scipion@cnb.csic.es)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import numpy as np
+
+from pwem.protocols import ProtAnalysis3D
+
+from pyworkflow.protocol import PointerParam, IntParam, FloatParam, StringParam, \
+    EnumParam, LEVEL_ADVANCED
+from pyworkflow import BETA
+import pyworkflow.utils as pwutils
+
+import spoc
+import spoc.constants as spocConst
+import spoc.fsc as spocFsc
+from spoc.convert import stageMap, parseResolution
+from spoc.objects import FdrFSC
+
+SUMMARY_FILE = 'summary.txt'
+SPOC_LOG = 'FSC_FDRcontrol.log'
+
+
+class ProtResolutionAnalysisFSCFDRBatch(ProtAnalysis3D):
+    """
+    Thresholding of FSC curves by FDR control for all the volumes of a set
+    """
+    _label = 'batch resolution Analysis'
+    _devStatus = BETA
+
+    # --------------------------- DEFINE param functions ------------------------
+    def _defineParams(self, form):
+        form.addSection(label='Input')
+        form.addParam('inputVolumes', PointerParam, pointerClass="SetOfVolumes",
+                      label='Volumes with half maps', important=True,
+                      help='The FDR-FSC analysis will be computed from the half maps '
+                           'of each volume of the set.')
+        form.addParam('sym', StringParam, default='c1',
+                      label='Volume symmetry',
+                      help='Symmetry for correction of symmetry effects')
+        form.addParam('numAsymUnits', IntParam, default=-1,
+                      label='Number of asymmetric units',
+                      expertLevel=LEVEL_ADVANCED,
+                      help='Number of asymmetric units for correction of symmetry effects. '
+                           'If set to -1, it will be taken from the symmetry')
+        form.addParam('engine', EnumParam, default=spocConst.ENGINE_SPOC,
+                      choices=['SPOC scripts', 'Single pass'],
+                      display=EnumParam.DISPLAY_HLIST,
+                      label='Resolution engine',
+                      help='SPOC scripts: run FSC_FDRcontrol.py for each pair of '
+                           'half maps, as the resolution analysis protocol does by '
+                           'default, so the resolutions are comparable with its '
+                           'runs.\n'
+                           'Single pass: compute the global FDR-FSC of each pair '
+                           'with the NumPy engine of the resolution analysis '
+                           'protocol, reusing the shell indices between pairs. '
+                           'It does not apply a B-factor.')
+        form.addParam('bfactor', FloatParam, default=-1,
+                      condition='engine==%d' % spocConst.ENGINE_SPOC,
+                      label='B-Factor',
+                      expertLevel=LEVEL_ADVANCED,
+                      help='B-Factor for sharpening of the maps. '
+                           'If set to -1, this parameter will not be used')
+
+        # Pairs are analyzed concurrently, one per thread
+        form.addParallelSection(threads=4, mpi=0)
+
+    # --------------------------- INSERT steps functions ------------------------
+    def _insertAllSteps(self):
+        self._insertFunctionStep(self.convertInputStep)
+        self._insertFunctionStep(self.computeControlStep)
+        self._insertFunctionStep(self.createOutputStep)
+
+    # --------------------------- STEPS functions -------------------------------
+    def convertInputStep(self):
+        samplingRate = self.inputVolumes.get().getSamplingRate()
+        jobs = []
+        for volId, halfOne, halfTwo in self.getHalfMapPairs():
+            pwutils.makePath(self._getTmpPath(self._getVolDir(volId)))
+            jobs.append((halfOne, self._getHalfMapPath(volId, 1)))
+            jobs.append((halfTwo, self._getHalfMapPath(volId, 2)))
+
+        with ThreadPoolExecutor(max_workers=self.getNumberOfWorkers()) as executor:
+            for _ in executor.map(lambda job: stageMap(job[0], job[1], samplingRate),
+                                  jobs):
+                pass
+
+    def computeControlStep(self):
+        apix = self.inputVolumes.get().getSamplingRate()
+        volIds = [volId for volId, _, _ in self.getHalfMapPairs()]
+        for volId in volIds:
+            pwutils.makePath(self._getExtraPath(self._getVolDir(volId)))
+
+        if self.engine.get() == spocConst.ENGINE_SPOC:
+            # Each script runs as a separate process, the threads just wait
+            with ThreadPoolExecutor(max_workers=self.getNumberOfWorkers()) as executor:
+                resolutions = list(executor.map(self.runSpocControl, volIds))
+        else:
+            numAsymUnits = self.numAsymUnits.get()
+            if numAsymUnits <= 0:
+                numAsymUnits = spocFsc.getSymmetryOrder(self.sym.get())
+            with ProcessPoolExecutor(max_workers=self.getNumberOfWorkers()) as executor:
+                futures = [executor.submit(spocFsc.analyzeHalfMaps,
+                                           self._getHalfMapPath(volId, 1),
+                                           self._getHalfMapPath(volId, 2),
+                                           apix, self._getExtraPath(self._getVolDir(volId)),
+                                           numAsymUnits,
+                                           shellCacheDir=spoc.Plugin.getShellCachePath())
+                           for volId in volIds]
+                resolutions = [future.result() for future in futures]
+
+        with open(self._getExtraPath(SUMMARY_FILE), 'w') as f:
+            f.write('# volumeId  resolution_1%_FDR-FSC (Angstrom)\n')
+            for volId, resolution in zip(volIds, resolutions):
+                f.write('%d %f\n' % (volId, resolution))
+
+    def runSpocControl(self, volId):
+        """ Run FSC_FDRcontrol.py on the half maps of a volume, in its extra
+        folder, and return the global resolution. """
+        outputDir = os.path.abspath(self._getExtraPath(self._getVolDir(volId)))
+        logFile = os.path.join(outputDir, SPOC_LOG)
+        args = '--halfmap1 %s --halfmap2 %s --symmetry %s --apix %f' \
+               % (os.path.abspath(self._getHalfMapPath(volId, 1)),
+                  os.path.abspath(self._getHalfMapPath(volId, 2)),
+                  self.sym.get().upper(), self.inputVolumes.get().getSamplingRate())
+        if self.bfactor.get() >= 0:
+            args += ' --bFactor %f' % self.bfactor.get()
+        # The output of each script is kept apart, to read its resolution
+        self.runJob(spoc.Plugin.getProgram('FSC_FDRcontrol.py'),
+                    args + ' > %s 2>&1' % logFile, cwd=outputDir)
+        spocFsc.loadCurve(outputDir)
+        resolution = parseResolution(logFile)
+        if resolution is None:
+            raise Exception("The global resolution was not found in %s" % logFile)
+        return resolution
+
+    def createOutputStep(self):
+        inputVolumes = self.inputVolumes.get()
+        fscSet = self._createSetOfFSCs()
+        for volId, resolution in self.getResolutions():
+            volume = inputVolumes[volId]
+            fsc = FdrFSC(objLabel='FSC %s' % (volume.getObjLabel() or volId))
+            fsc.setCurveFile(self._getExtraPath(self._getVolDir(volId), spocFsc.FSC_NPY))
+            fscSet.append(fsc)
+
+        self._defineOutputs(outputFSCs=fscSet)
+        self._defineSourceRelation(self.inputVolumes, fscSet)
+
+    # --------------------------- UTILS functions -----------------------------
+    def _getVolDir(self, volId):
+        return 'volume_%06d' % volId
+
+    def _getHalfMapPath(self, volId, half):
+        return self._getTmpPath(self._getVolDir(volId), 'half%d.mrc' % half)
+
+    def getHalfMapPairs(self):
+        """ Return a list of (volId, halfMap1, halfMap2) for the input set. """
+        pairs = []
+        for volume in self.inputVolumes.get().iterItems():
+            halfMaps = volume.getHalfMaps()
+            if halfMaps:
+                halfOne, halfTwo = halfMaps.split(',')
+                pairs.append((volume.getObjId(), halfOne, halfTwo))
+        return pairs
+
+    def getNumberOfWorkers(self):
+        return max(1, self.numberOfThreads.get()) * max(1, self.numberOfMpi.get())
+
+    def getResolutions(self):
+        """ Return a list of (volId, resolution) from the summary table. """
+        summaryFile = self._getExtraPath(SUMMARY_FILE)
+        if not os.path.exists(summaryFile):
+            return []
+        data = np.loadtxt(summaryFile, ndmin=2)
+        return [(int(volId), resolution) for volId, resolution in data]
+
+    # --------------------------- INFO functions ------------------------------
+    def _methods(self):
+        methods = []
+        methods.append('Significance analysis of FSC curves for a set of volumes')
+        methods.append('Resolution engine: %s' % self.getEnumText('engine'))
+        return methods
+
+    def _summary(self):
+        summary = []
+        if not self.isFinished():
+            summary.append("FDR-FSC information not ready yet.")
+        for volId, resolution in self.getResolutions():
+            summary.append('Volume %d: resolution at 1 %% FDR-FSC: %.2f Angstrom'
+                           % (volId, resolution))
+        return summary
+
+    def _validate(self):
+        errors = []
+        inputVolumes = self.inputVolumes.get()
+        if inputVolumes and not all(volume.getHalfMaps()
+                                    for volume in inputVolumes.iterItems()):
+            errors.append("All the input volumes must have associated half maps")
+        return errors
@@ -0,0 +1,106 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team (scipion@cnb.csic.es)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+
+
+"""
+Helpers to run the SPOC scripts inside the current interpreter.
+
+The scripts are imported only once per process, so numpy, scipy, mrcfile and
+the SPOC utilities they depend on are not imported again for every job.
+"""
+
+import importlib.util
+import os
+import runpy
+import shlex
+import sys
+import threading
+
+# sys.argv and the working directory are process wide, so only one script can
+# be running at a time in the same interpreter
+_lock = threading.RLock()
+_modules = {}
+
+
+def loadScript(scriptPath):
+    """ Import a SPOC script as a module (cached after the first call). """
+    scriptPath = os.path.abspath(scriptPath)
+    with _lock:
+        if scriptPath not in _modules:
+            sourceDir = os.path.dirname(scriptPath)
+            if sourceDir not in sys.path:
+                sys.path.insert(0, sourceDir)
+            name = 'spoc_' + os.path.splitext(os.path.basename(scriptPath))[0]
+            spec = importlib.util.spec_from_file_location(name, scriptPath)
+            module = importlib.util.module_from_spec(spec)
+            oldArgv = sys.argv
+            # Some scripts parse the command line when imported
+            sys.argv = [scriptPath]
+            try:
+                spec.loader.exec_module(module)
+            finally:
+                sys.argv = oldArgv
+            _modules[scriptPath] = module
+        return _modules[scriptPath]
+
+
+def canRunInProcess(scriptPath):
+    """ Check whether the script (and its dependencies) can be imported in
+    this interpreter. """
+    try:
+        loadScript(scriptPath)
+        return True
+    except (Exception, SystemExit) as e:
+        print("Cannot import %s in-process (%s), it will be run as "
+              "a separate process." % (scriptPath, e))
+        return False
+
+
+def runScript(scriptPath, args, cwd=None):
+    """ Run a SPOC script with the given command line arguments in the current
+    interpreter. The script is executed through its main() function when
+    available, otherwise the script body is evaluated as __main__ (reusing
+    all the modules already imported). """
+    scriptPath = os.path.abspath(scriptPath)
+    with _lock:
+        module = loadScript(scriptPath)
+        oldArgv, oldCwd = sys.argv, os.getcwd()
+        sys.argv = [scriptPath] + shlex.split(args)
+        try:
+            if cwd:
+                os.chdir(cwd)
+            if callable(getattr(module, 'main', None)):
+                module.main()
+            else:
+                runpy.run_path(scriptPath, run_name='__main__')
+        except SystemExit as e:
+            if e.code not in (None, 0):
+                raise Exception("%s %s failed with exit code %s"
+                                % (scriptPath, args, e.code))
+        finally:
+            sys.argv = oldArgv
+            os.chdir(oldCwd)
+            sys.stdout.flush()
+            sys.stderr.flush()
@@ -0,0 +1,105 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team (scipion@cnb.csic.es)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+
+
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import spoc
+import spoc.cache as spocCache
+
+
+class TestCache(unittest.TestCase):
+    """ Checks of the content addressed cache in a temporary folder """
+
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+        self.cacheDir = os.path.join(self.tmpDir, 'cache')
+        patcher = mock.patch.multiple(spoc, CACHEDIR=self.cacheDir, CACHESIZE=50)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.inputFile = self._writeFile('input.mrc', b'half map')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir)
+
+    def _writeFile(self, fileName, content):
+        fileName = os.path.join(self.tmpDir, fileName)
+        with open(fileName, 'wb') as f:
+            f.write(content)
+        return fileName
+
+    def _storeEntry(self, key, name, size):
+        outputDir = os.path.join(self.tmpDir, name)
+        os.makedirs(outputDir)
+        with open(os.path.join(outputDir, 'result.txt'), 'wb') as f:
+            f.write(os.urandom(size))
+        spocCache.store(key, outputDir)
+        return outputDir
+
+    def test_hit(self):
+        key = spocCache.getCacheKey([self.inputFile], apix=1.0, localRes=True)
+        outputDir = self._storeEntry(key, 'run1', 100)
+        # An existing entry is not replaced
+        self._writeFile(os.path.join('run1', 'FSC.txt'), b'0.1 0.9\n')
+        spocCache.store(key, outputDir)
+        retrievedDir = os.path.join(self.tmpDir, 'run2')
+        self.assertTrue(spocCache.retrieve(key, retrievedDir))
+        self.assertEqual(os.listdir(retrievedDir), ['result.txt'])
+        with open(os.path.join(outputDir, 'result.txt'), 'rb') as f:
+            expected = f.read()
+        with open(os.path.join(retrievedDir, 'result.txt'), 'rb') as f:
+            self.assertEqual(f.read(), expected)
+
+    def test_miss(self):
+        key = spocCache.getCacheKey([self.inputFile], apix=1.0, localRes=True)
+        self._storeEntry(key, 'run1', 100)
+        self.assertEqual(key, spocCache.getCacheKey([self.inputFile], localRes=True,
+                                                    apix=1.0))
+        otherKeys = [spocCache.getCacheKey([self.inputFile], apix=1.1, localRes=True),
+                     spocCache.getCacheKey([self.inputFile], apix=1.0, localRes=False)]
+        self._writeFile('input.mrc', b'other half map')
+        otherKeys.append(spocCache.getCacheKey([self.inputFile], apix=1.0, localRes=True))
+        for otherKey in otherKeys:
+            self.assertNotEqual(otherKey, key)
+            retrievedDir = os.path.join(self.tmpDir, 'retrieved')
+            self.assertFalse(spocCache.retrieve(otherKey, retrievedDir))
+            self.assertFalse(os.path.exists(retrievedDir))
+
+    def test_eviction(self):
+        keys = ['entry%d' % i for i in range(3)]
+        for i, key in enumerate(keys):
+            self._storeEntry(key, 'run%d' % i, 1000)
+            # The first entry is the oldest one
+            os.utime(os.path.join(self.cacheDir, key), (1000 + i, 1000 + i))
+        # Retrieving an entry makes it the most recently used
+        spocCache.retrieve(keys[0], os.path.join(self.tmpDir, 'retrieved'))
+        spocCache.evict(maxSize=2500 / 1024 ** 3)
+        self.assertEqual(sorted(os.listdir(self.cacheDir)), [keys[0], keys[2]])
+        spocCache.evict(maxSize=1500 / 1024 ** 3)
+        self.assertEqual(os.listdir(self.cacheDir), [keys[0]])
@@ -0,0 +1,111 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team (scipion@cnb.csic.es)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+
+
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy as np
+import mrcfile
+
+import spoc
+from spoc.convert import isCompliantMrc, stageMap, getScratchPath, scratchFolder
+
+
+class FakeProtocol:
+    def __init__(self, workingDir):
+        self.workingDir = workingDir
+
+    def getWorkingDir(self):
+        return self.workingDir
+
+
+class TestStageMap(unittest.TestCase):
+    """ Checks of the staging of the input maps in the scratch folder """
+
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+        patcher = mock.patch.object(spoc, 'SCRATCHDIR', os.path.join(self.tmpDir, 'scratch'))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.protocol = FakeProtocol(os.path.join(self.tmpDir, 'Runs', '000042_Prot'))
+        self.data = np.random.default_rng(0).normal(size=(16, 16, 16))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir)
+
+    def _writeMap(self, fileName, dtype=np.float32, extendedHeader=None):
+        fileName = os.path.join(self.tmpDir, fileName)
+        with mrcfile.new(fileName) as mrc:
+            mrc.set_data(self.data.astype(dtype))
+            mrc.voxel_size = 1.5
+            if extendedHeader is not None:
+                mrc.set_extended_header(extendedHeader)
+        return fileName
+
+    def _stage(self, fileName):
+        stagedFile = getScratchPath(self.protocol, 'tmp', 'halfone.mrc')
+        os.makedirs(os.path.dirname(stagedFile), exist_ok=True)
+        return stagedFile, stageMap(fileName, stagedFile, 1.5)
+
+    def _checkConverted(self, fileName):
+        self.assertFalse(isCompliantMrc(fileName, 1.5))
+        stagedFile, linked = self._stage(fileName)
+        self.assertFalse(linked)
+        self.assertFalse(os.path.samefile(stagedFile, fileName))
+        self.assertTrue(isCompliantMrc(stagedFile, 1.5))
+        with mrcfile.open(stagedFile) as mrc:
+            np.testing.assert_allclose(mrc.data, self.data.astype(np.float32), atol=1e-6)
+
+    def test_float32_linked(self):
+        fileName = self._writeMap('half.mrc')
+        self.assertTrue(isCompliantMrc(fileName, 1.5))
+        self.assertFalse(isCompliantMrc(fileName, 1.0))
+        stagedFile, linked = self._stage(fileName)
+        self.assertTrue(linked)
+        self.assertTrue(os.path.samefile(stagedFile, fileName))
+
+    def test_extended_header_converted(self):
+        self._checkConverted(self._writeMap('half.mrc', extendedHeader=np.zeros(256, dtype='V1')))
+
+    def test_mode_converted(self):
+        self.data = np.round(self.data * 100)
+        self._checkConverted(self._writeMap('half.mrc', dtype=np.int16))
+
+    def test_scratch_removed(self):
+        fileName = self._writeMap('half.mrc')
+        with self.assertRaises(RuntimeError):
+            with scratchFolder(self.protocol) as scratchDir:
+                stagedFile, _ = self._stage(fileName)
+                self.assertTrue(stagedFile.startswith(scratchDir))
+                raise RuntimeError('Step failed')
+        self.assertFalse(os.path.exists(getScratchPath(self.protocol)))
+        self.assertTrue(os.path.exists(fileName))
+        with scratchFolder(self.protocol, enabled=False):
+            self._stage(fileName)
+        self.assertTrue(os.path.exists(getScratchPath(self.protocol)))
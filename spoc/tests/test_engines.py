@@ -0,0 +1,243 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team (scipion@cnb.csic.es)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+
+
+import collections
+import io
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy as np
+from scipy import ndimage
+import mrcfile
+
+import spoc.fdr as spocFdr
+import spoc.fsc as spocFsc
+
+
+def _writeMap(fileName, data, apix=1.0):
+    with mrcfile.new(fileName, overwrite=True) as mrc:
+        mrc.set_data(data.astype(np.float32))
+        mrc.voxel_size = apix
+
+
+def _readMap(fileName):
+    with mrcfile.open(fileName, permissive=True) as mrc:
+        return np.array(mrc.data, dtype=np.float64)
+
+
+class TestConfidenceMapEngine(unittest.TestCase):
+    """ Checks of the chunked confidence map engine on synthetic maps """
+
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+        rng = np.random.default_rng(0)
+        data = rng.normal(size=(48, 48, 48))
+        data[16:32, 16:32, 16:32] += 8
+        # Strongly negative density, whose float32 p-values would round to 1
+        data[36:44, 20:30, 20:30] = -8
+        self.inputFile = self._path('input.mrc')
+        _writeMap(self.inputFile, data)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir)
+
+    def _path(self, fileName):
+        return os.path.join(self.tmpDir, fileName)
+
+    def test_rethreshold_same_method(self):
+        spocFdr.confidenceMap(self.inputFile, self._path('conf.mrc'),
+                              self._path('log.mrc'), 1.0, slabSize=7,
+                              zScoresFile=self._path('zScores.npz'))
+        spocFdr.rethreshold(self._path('zScores.npz'), self._path('reConf.mrc'),
+                            self._path('reLog.mrc'), 1.0, slabSize=5)
+        conf, reConf = _readMap(self._path('conf.mrc')), _readMap(self._path('reConf.mrc'))
+        log, reLog = _readMap(self._path('log.mrc')), _readMap(self._path('reLog.mrc'))
+        self.assertTrue(np.all(np.isfinite(reConf)) and np.all(np.isfinite(reLog)))
+        self.assertLess(np.abs(conf - reConf).max(), 1e-3)
+        self.assertLess(np.abs(log - reLog).max(), 0.05)
+
+    def test_rethreshold_bonferroni(self):
+        spocFdr.confidenceMap(self.inputFile, self._path('conf.mrc'),
+                              self._path('log.mrc'), 1.0,
+                              zScoresFile=self._path('zScores.npz'))
+        spocFdr.rethreshold(self._path('zScores.npz'), self._path('reConf.mrc'),
+                            self._path('reLog.mrc'), 1.0,
+                            method=spocFdr.METHOD_BONFERRONI,
+                            maskFile=self._path('mask.mrc'))
+        reConf, mask = _readMap(self._path('reConf.mrc')), _readMap(self._path('mask.mrc'))
+        self.assertTrue(np.all(np.isfinite(reConf)))
+        # The signal cube is significant, the negative block is not
+        self.assertGreater(mask[20:28, 20:28, 20:28].mean(), 0.9)
+        self.assertEqual(mask[36:44, 20:30, 20:30].max(), 0)
+
+    def test_constant_noise(self):
+        # Zero padding in y and x, where the noise boxes are placed by default
+        data = _readMap(self.inputFile)
+        data[:, :8] = data[:, -8:] = 0
+        data[:, :, :8] = data[:, :, -8:] = 0
+        _writeMap(self.inputFile, data)
+        with self.assertRaises(ValueError):
+            spocFdr.confidenceMap(self.inputFile, self._path('conf.mrc'),
+                                  self._path('log.mrc'), 1.0, boxSize=8)
+        self.assertFalse(os.path.exists(self._path('conf.mrc')))
+
+
+class TestFdrFscEngine(unittest.TestCase):
+    """ Checks of the single pass FDR-FSC engine on synthetic half maps """
+
+    def test_vectorized_permutation_null(self):
+        # Low pass signal, so that the resolution is not Nyquist
+        rng = np.random.default_rng(1)
+        signal = ndimage.gaussian_filter(rng.normal(size=(48, 48, 48)), 2) * 5
+        half1 = signal + rng.normal(size=signal.shape)
+        half2 = signal + rng.normal(size=signal.shape)
+        shells = spocFsc.getShellIndices(half1.shape)
+        f1, f2 = np.fft.rfftn(half1), np.fft.rfftn(half2)
+        mean, std = spocFsc.permutationNull(f1, f2, shells, 25)
+        vMean, vStd = spocFsc.permutationNullVectorized(f1, f2, shells, 25)
+        # Both are estimates from 1000 permutations, they agree up to sampling
+        self.assertLess((np.abs(vMean - mean) / std)[1:].max(), 0.25)
+        np.testing.assert_allclose(vStd[1:], std[1:], rtol=0.15)
+
+        result = spocFsc.globalFsc(half1, half2, 1.0)
+        vResult = spocFsc.globalFsc(half1, half2, 1.0, vectorized=True)
+        self.assertGreater(result.resolution, 3.0)
+        self.assertEqual(vResult.resolution, result.resolution)
+
+    def _getPhantom(self, seed):
+        # Low pass filtered phantom inside a sphere, whose signal fades along x,
+        # with independent noise in each half map
+        rng = np.random.default_rng(seed)
+        zz, yy, xx = np.indices((64, 64, 64)) - 32
+        mask = (xx ** 2 + yy ** 2 + zz ** 2 < 20 ** 2).astype(np.float32)
+        signal = ndimage.gaussian_filter(rng.normal(size=mask.shape), 2) * mask * 40
+        signal *= np.exp(-(xx + 20) / 20.0)
+        half1 = signal + rng.normal(size=mask.shape)
+        half2 = signal + rng.normal(size=mask.shape)
+        return half1, half2, mask
+
+    def test_shell_cache(self):
+        shapes = [(n, n, n) for n in range(8, 8 + 4 * spocFsc.SHELL_CACHE_SIZE, 2)]
+        with mock.patch.object(spocFsc, '_shellCache', collections.OrderedDict()):
+            first = spocFsc.getShellIndices(shapes[0])
+            for shape in shapes[1:]:
+                spocFsc.getShellIndices(shape)
+                # The first shape is used again, so it is never the oldest one
+                self.assertIs(spocFsc.getShellIndices(shapes[0]), first)
+            self.assertEqual(len(spocFsc._shellCache), spocFsc.SHELL_CACHE_SIZE)
+            self.assertIn(shapes[-1], spocFsc._shellCache)
+            self.assertNotIn(shapes[1], spocFsc._shellCache)
+
+    def test_shell_cache_store_error(self):
+        tmpDir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpDir)
+        # A file where the cache folder should be
+        cacheDir = os.path.join(tmpDir, 'shells')
+        open(cacheDir, 'w').close()
+        with mock.patch.object(spocFsc, '_shellCacheDir', cacheDir), \
+                mock.patch('sys.stderr', new_callable=io.StringIO) as stderr:
+            indices = spocFsc._loadShellIndices((10, 10, 10))
+        np.testing.assert_array_equal(indices, spocFsc._computeShellIndices((10, 10, 10)))
+        self.assertIn('could not store the shell indices', stderr.getvalue())
+
+    def test_batched_windows(self):
+        half1, half2, mask = self._getPhantom(4)
+        loop = spocFsc.localResolutions(half1, half2, 1.0, mask=mask, restrictToMask=True)
+        batched = spocFsc.localResolutions(half1, half2, 1.0, mask=mask, restrictToMask=True,
+                                           batchSize=16)
+        inside = mask > 0.5
+        self.assertGreater(np.ptp(loop[inside]), 1.0)
+        np.testing.assert_allclose(batched, loop, atol=1e-3)
+
+    def test_worker_slabs(self):
+        half1, half2, mask = self._getPhantom(5)
+        for batchSize in [0, 16]:
+            single = spocFsc.localResolutions(half1, half2, 1.0, mask=mask,
+                                              restrictToMask=True, batchSize=batchSize)
+            slabs = spocFsc.localResolutions(half1, half2, 1.0, mask=mask,
+                                             restrictToMask=True, batchSize=batchSize,
+                                             numberOfWorkers=2)
+            np.testing.assert_allclose(slabs, single, atol=1e-6)
+
+    def test_symmetric_scan_box_64(self):
+        # C4 around z of the voxels 1..63, whose center is the symmetry origin 32
+        rng = np.random.default_rng(2)
+        signal = rng.normal(size=(64, 64, 64))
+        halves = [signal + rng.normal(size=signal.shape) for _ in range(2)]
+        for half in halves:
+            inner = half[1:, 1:, 1:]
+            inner[:] = sum(np.rot90(inner, k, axes=(1, 2)) for k in range(4)) / 4
+        locRes = spocFsc.localResolutions(halves[0], halves[1], 1.0, sym='C4')
+        inner = locRes[1:, 1:, 1:]
+        np.testing.assert_allclose(np.rot90(inner, axes=(1, 2)), inner, atol=1e-6)
+
+    def test_preview_window_size(self):
+        half1, half2, mask = self._getPhantom(3)
+        resolution = spocFsc.globalFsc(half1, half2, 1.0).resolution
+        full = spocFsc.localResolutions(half1, half2, 1.0, mask=mask)
+        preview, boxSize = spocFsc.previewLocalResolutions(half1, half2, 1.0,
+                                                           resolution, mask=mask)
+        self.assertLess(boxSize, 64)
+        inside = mask > 0.5
+        # The windows of the preview cover the same volume, so there is no bias
+        # towards better resolution
+        self.assertLess(abs(np.median(preview[inside]) - np.median(full[inside])),
+                        0.15 * np.median(full[inside]))
+
+    def test_refine_windows(self):
+        # 4 and 5 A (shells 5 and 4 of a 20 A window) alternate, which is within
+        # the tolerance, and a 10 A (shell 2) corner, which is not. Only the
+        # cells with corners on both sides are refined, not the ones inside the
+        # uniform 10 A corner
+        coarse = np.full((6, 6, 6), 4.0)
+        coarse[::2] = 5.0
+        coarse[4:, 4:, 4:] = 10.0
+        refine = spocFsc.getRefineWindows(coarse, (24, 24, 24), 4, 20.0)
+        expected = np.zeros((24, 24, 24), dtype=bool)
+        expected[12:, 12:, 12:] = True
+        expected[16:, 16:, 16:] = False
+        np.testing.assert_array_equal(refine, expected)
+
+    def test_adaptive_windows(self):
+        # Smooth map: signal in the whole box, fading along x
+        rng = np.random.default_rng(5)
+        xx = np.arange(96) - 48
+        signal = ndimage.gaussian_filter(rng.normal(size=(96, 96, 96)), 2) * 40
+        signal *= np.exp(-(xx + 48) / 96.0)
+        half1 = signal + rng.normal(size=signal.shape)
+        half2 = signal + rng.normal(size=signal.shape)
+        full = spocFsc.localResolutions(half1, half2, 1.0, batchSize=64)
+        with mock.patch.object(spocFsc, '_scanGrid', wraps=spocFsc._scanGrid) as scan:
+            adaptive = spocFsc.adaptiveLocalResolutions(half1, half2, 1.0, batchSize=64)
+        computed = sum(call[0][7].sum() for call in scan.call_args_list)
+        total = np.prod([len(c) for c in spocFsc.getWindowCenters(half1.shape, 20, 5)])
+        self.assertLess(computed, total / 2)
+        error = np.abs(adaptive - full)
+        self.assertLess(np.median(error), 0.25)
+        self.assertLess(error.mean(), 0.5)
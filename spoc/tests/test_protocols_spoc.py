@@ -25,11 +25,20 @@
 # **************************************************************************
 
 
+import re
+
+import numpy as np
+
+from pwem.emlib.image import ImageHandler
 from pwem.protocols import ProtImportVolumes
 
 from pyworkflow.tests import BaseTest, setupTestProject, DataSet
 
-from spoc.protocols import ProtResolutionAnalysisFSCFDR, ProtConfidenceMap
+from spoc.constants import (ENGINE_SPOC, ENGINE_SINGLE_PASS, CONFIDENCE_ENGINE_CHUNKED,
+                            PRECISION_FLOAT32)
+from spoc.protocols import (ProtResolutionAnalysisFSCFDR, ProtConfidenceMap,
+                            ProtConfidenceMapThreshold, ProtResolutionAnalysisFSCFDRBatch,
+                            ProtConfidenceMapBatch)
 
 
 class TestFscFdrControl(BaseTest):
@@ -42,6 +51,37 @@ class TestFscFdrControl(BaseTest):
         cls.volume = cls.dataset.getFile('volumes/reference_masked.vol')
         cls.halfOne = cls.runImportVolumes(cls, cls.volume, 1, 'Halfmap One')
         cls.halfTwo = cls.runImportVolumes(cls, cls.volume, 1, 'Halfmap One')
+        # Independent half maps, so that the local FSC varies between windows
+        cls.noisyHalfOne = cls.runImportVolumes(cls, cls.writeNoisyMap(cls, 1), 1,
+                                                'Noisy halfmap One')
+        cls.noisyHalfTwo = cls.runImportVolumes(cls, cls.writeNoisyMap(cls, 2), 1,
+                                                'Noisy halfmap Two')
+
+    def runImportVolumeSet(self, label):
+        """ Import the two noisy maps as a set of volumes, each one with both
+        noisy maps as half maps (in a different order). """
+        protImport = self.newProtocol(ProtImportVolumes, filesPath=self.getOutputPath(),
+                                      filesPattern='noisy_half_*.mrc', samplingRate=1,
+                                      objLabel=label)
+        self.launchProtocol(protImport)
+        volumes = protImport.outputVolumes
+        halfMaps = sorted(volume.getFileName() for volume in volumes)
+        for volume in [volume.clone() for volume in volumes]:
+            volume.setHalfMaps(halfMaps if volume.getFileName() == halfMaps[0]
+                               else halfMaps[::-1])
+            volumes.update(volume)
+        volumes.write()
+        return volumes
+
+    def writeNoisyMap(cls, seed):
+        """ Write the test volume plus white noise of the same standard deviation. """
+        image = ImageHandler().read(cls.volume)
+        data = image.getData()
+        noise = np.random.default_rng(seed).normal(scale=data.std(), size=data.shape)
+        image.setData((data + noise).astype(np.float32))
+        fileName = cls.getOutputPath('noisy_half_%d.mrc' % seed)
+        image.write(fileName)
+        return fileName
 
     def runImportVolumes(cls, pattern, samplingRate, label):
         """ Run an Import particles protocol. """
@@ -50,9 +90,9 @@ class TestFscFdrControl(BaseTest):
         cls.launchProtocol(protImport)
         return protImport.outputVolume
 
-    def runFscFdrControl(self, halfOne, halfTwo, localRes, label):
+    def runFscFdrControl(self, halfOne, halfTwo, localRes, label, **kwargs):
         prot = self.newProtocol(ProtResolutionAnalysisFSCFDR, halfOne=halfOne, halfTwo=halfTwo,
-                                localRes=localRes, objLabel=label)
+                                localRes=localRes, objLabel=label, **kwargs)
         self.launchProtocol(prot)
         if localRes:
             self.assertIsNotNone(prot.outputLocalResMap,
@@ -62,8 +102,9 @@ class TestFscFdrControl(BaseTest):
                                  "There was a problem with FSC-FdR protocol output (Global FSC)")
         return prot
 
-    def runConfidenceMap(self, map, label):
-        prot = self.newProtocol(ProtConfidenceMap, inputMap=map, locResFilter=False, objLabel=label)
+    def runConfidenceMap(self, map, label, **kwargs):
+        prot = self.newProtocol(ProtConfidenceMap, inputMap=map, locResFilter=False,
+                                objLabel=label, **kwargs)
         self.launchProtocol(prot)
         self.assertIsNotNone(prot.confidenceMap,
                              "There was a problem with Confidence Map protocol output")
@@ -73,12 +114,7 @@ class TestFscFdrControl(BaseTest):
 
     def test_fsc_fdr_control_fsc(self):
         prot = self.runFscFdrControl(self.halfOne, self.halfTwo, False, 'Global FSC')
-        stdout = prot._getLogsPath('run.stdout')
-        with open(stdout) as file:
-            for num, line in enumerate(file, 1):
-                if 'Resolution at 1 % FDR-FSC' in line:
-                    res = [float(s) for s in line.split() if s.replace(".", "", 1).isdigit()][1]
-        self.assertEqual(res, 2.0, msg="Unexpected resolution value")
+        self.assertEqual(prot.globalResolution.get(), 2.0, msg="Unexpected resolution value")
         return prot
 
     def test_fsc_fdr_control_locres(self):
@@ -86,7 +122,222 @@ class TestFscFdrControl(BaseTest):
         prot = self.runFscFdrControl(self.halfOne, self.halfTwo, True, 'Local resolution')
         return prot
 
+    def test_fsc_fdr_control_single_pass(self):
+        prot = self.runFscFdrControl(self.halfOne, self.halfTwo, True, 'Single pass',
+                                     engine=ENGINE_SINGLE_PASS)
+        self.assertIsNotNone(prot.outputFSC,
+                             "There was a problem with FSC-FdR protocol output (Global FSC)")
+        self.assertEqual(prot.globalResolution.get(), 2.0, msg="Unexpected resolution value")
+        frequencies, fsc, threshold = prot.outputFSC.getArrays()
+        self.assertEqual(len(frequencies), len(threshold),
+                         "The FDR threshold curve was not stored with the FSC")
+        return prot
+
+    def test_fsc_fdr_control_single_pass_vs_spoc(self):
+        protSpoc = self.runFscFdrControl(self.noisyHalfOne, self.noisyHalfTwo, False,
+                                         'FSC_FDRcontrol.py reference')
+        prot = self.runFscFdrControl(self.noisyHalfOne, self.noisyHalfTwo, False,
+                                     'Single pass (noisy halves)', engine=ENGINE_SINGLE_PASS)
+        resSpoc, res = protSpoc.globalResolution.get(), prot.globalResolution.get()
+        shell = 1.0 / (self.noisyHalfOne.getDim()[0] * self.noisyHalfOne.getSamplingRate())
+        print("Single pass vs FSC_FDRcontrol.py: %.2f vs %.2f A" % (res, resSpoc))
+        self.assertGreater(resSpoc, 2.0, "The noisy halves are resolved at Nyquist")
+        self.assertLessEqual(abs(1.0 / res - 1.0 / resSpoc), 1.01 * shell,
+                             "The single pass resolution differs by more than one "
+                             "Fourier shell from FSC_FDRcontrol.py")
+        fscSpoc = np.asarray(protSpoc.outputFSC.getData()[1])
+        fsc = np.asarray(prot.outputFSC.getArrays()[1])
+        size = min(len(fsc), len(fscSpoc))
+        self.assertLess(np.abs(fsc[:size] - fscSpoc[:size]).max(), 0.05,
+                        "The single pass FSC curve differs from FSC_FDRcontrol.py")
+
+    def test_fsc_fdr_control_vectorized_null(self):
+        protLoop = self.runFscFdrControl(self.noisyHalfOne, self.noisyHalfTwo, False,
+                                         'Per shell permutations', engine=ENGINE_SINGLE_PASS,
+                                         vectorizedNull=False)
+        prot = self.runFscFdrControl(self.noisyHalfOne, self.noisyHalfTwo, False,
+                                     'Vectorized permutations', engine=ENGINE_SINGLE_PASS,
+                                     vectorizedNull=True)
+        self.assertEqual(prot.globalResolution.get(), protLoop.globalResolution.get(),
+                         msg="The vectorized permutation test changed the resolution")
+        threshold = np.asarray(prot.outputFSC.getArrays()[2])
+        loopThreshold = np.asarray(protLoop.outputFSC.getArrays()[2])
+        self.assertLess(np.abs(threshold - loopThreshold).max(), 0.05,
+                        "The FDR thresholds of both permutation tests differ")
+
+    def test_fsc_fdr_control_float32(self):
+        prot64 = self.runFscFdrControl(self.noisyHalfOne, self.noisyHalfTwo, True,
+                                       'Single pass float64', engine=ENGINE_SINGLE_PASS)
+        prot32 = self.runFscFdrControl(self.noisyHalfOne, self.noisyHalfTwo, True,
+                                       'Single pass float32', engine=ENGINE_SINGLE_PASS,
+                                       precision=PRECISION_FLOAT32)
+        self.assertEqual(prot32.globalResolution.get(), prot64.globalResolution.get(),
+                         msg="float32 changed the global resolution")
+        fsc64, fsc32 = prot64.outputFSC.getArrays()[1], prot32.outputFSC.getArrays()[1]
+        locRes64 = ImageHandler().read(prot64.outputLocalResMap.getFileName()).getData()
+        locRes32 = ImageHandler().read(prot32.outputLocalResMap.getFileName()).getData()
+        fscDiff = np.abs(np.asarray(fsc32) - np.asarray(fsc64)).max()
+        locResDiff = np.abs(locRes32 - locRes64)
+        print("float32 vs float64: max FSC difference %g, local resolution "
+              "max difference %g A, %.3f %% of voxels differ"
+              % (fscDiff, locResDiff.max(), 100 * np.mean(locResDiff > 0)))
+        self.assertLess(fscDiff, 1e-4, "FSC differs between float32 and float64")
+        self.assertLess(np.mean(locResDiff > 0.5), 0.01,
+                        "Local resolution differs between float32 and float64")
+
+    def test_fsc_fdr_control_batched(self):
+        protBatched = self.runFscFdrControl(self.noisyHalfOne, self.noisyHalfTwo, True,
+                                            'Batched windows', engine=ENGINE_SINGLE_PASS)
+        protLoop = self.runFscFdrControl(self.noisyHalfOne, self.noisyHalfTwo, True,
+                                         'Window by window', engine=ENGINE_SINGLE_PASS,
+                                         batchSize=0)
+        locResBatched = ImageHandler().read(protBatched.outputLocalResMap.getFileName()).getData()
+        locResLoop = ImageHandler().read(protLoop.outputLocalResMap.getFileName()).getData()
+        self.assertGreater(len(np.unique(locResLoop.round(1))), 10,
+                           "The local resolution does not vary between windows")
+        self.assertTrue(np.allclose(locResBatched, locResLoop, atol=1e-3),
+                        "Batched and window by window local resolutions differ")
+
+    def test_fsc_fdr_control_adaptive(self):
+        protFull = self.runFscFdrControl(self.noisyHalfOne, self.noisyHalfTwo, True,
+                                         'Full step', engine=ENGINE_SINGLE_PASS)
+        protAdaptive = self.runFscFdrControl(self.noisyHalfOne, self.noisyHalfTwo, True,
+                                             'Adaptive', engine=ENGINE_SINGLE_PASS,
+                                             adaptive=True)
+        locResFull = ImageHandler().read(protFull.outputLocalResMap.getFileName()).getData()
+        locResAdaptive = ImageHandler().read(protAdaptive.outputLocalResMap.getFileName()).getData()
+        self.assertLess(np.median(np.abs(locResAdaptive - locResFull)), 0.5,
+                        "Adaptive local resolution too far from the full step one")
+
+    def test_fsc_fdr_control_preview(self):
+        protFull = self.runFscFdrControl(self.noisyHalfOne, self.noisyHalfTwo, True,
+                                         'Full local resolution', engine=ENGINE_SINGLE_PASS)
+        prot = self.runFscFdrControl(self.noisyHalfOne, self.noisyHalfTwo, True, 'Preview',
+                                     engine=ENGINE_SINGLE_PASS, preview=True)
+        boxSize = self.noisyHalfOne.getDim()[2]
+        with open(prot._getLogsPath('run.stdout')) as f:
+            cropped = re.search(r'cropped from (\d+) to (\d+) voxels', f.read())
+        self.assertIsNotNone(cropped, "The preview box size was not reported")
+        self.assertEqual(int(cropped.group(1)), boxSize)
+        self.assertLess(int(cropped.group(2)), boxSize, "The half maps were not cropped")
+        locRes = ImageHandler().read(prot.outputLocalResMap.getFileName()).getData()
+        locResFull = ImageHandler().read(protFull.outputLocalResMap.getFileName()).getData()
+        self.assertEqual(locRes.shape, (boxSize,) * 3,
+                         "The preview was not upsampled to the input box")
+        self.assertIn('preview', prot.outputLocalResMap.getObjLabel())
+        median, medianFull = np.median(locRes), np.median(locResFull)
+        print("Preview vs full: median local resolution %.2f vs %.2f A"
+              % (median, medianFull))
+        self.assertLess(abs(median - medianFull), 0.15 * medianFull,
+                        "The preview local resolution differs from the full run")
+
+    def test_fsc_fdr_control_symmetric_scan(self):
+        prot = self.runFscFdrControl(self.noisyHalfOne, self.noisyHalfTwo, True,
+                                     'Asymmetric unit scan',
+                                     engine=ENGINE_SINGLE_PASS, sym='c4', symmetricScan=True)
+        locRes = ImageHandler().read(prot.outputLocalResMap.getFileName()).getData()
+        # The filled map has the C4 symmetry around z
+        self.assertTrue(np.allclose(locRes[1:, 1:, 1:], np.rot90(locRes[1:, 1:, 1:], axes=(1, 2)),
+                                    atol=1e-3), "The local resolution map is not symmetric")
+
+    def test_fsc_fdr_control_batch(self):
+        volumes = self.runImportVolumeSet('Volumes with half maps')
+        protSingle = self.runFscFdrControl(self.noisyHalfOne, self.noisyHalfTwo, False,
+                                           'Single run (SPOC)')
+        for engine in (ENGINE_SPOC, ENGINE_SINGLE_PASS):
+            prot = self.newProtocol(ProtResolutionAnalysisFSCFDRBatch, inputVolumes=volumes,
+                                    engine=engine, objLabel='Batch (engine %d)' % engine)
+            self.launchProtocol(prot)
+            self.assertEqual(prot.outputFSCs.getSize(), 2,
+                             "Missing FSC curves in the batch output")
+            resolutions = [resolution for _, resolution in prot.getResolutions()]
+            self.assertEqual(len(resolutions), 2)
+            if engine == ENGINE_SPOC:
+                # Same script and half maps as the single run
+                for resolution in resolutions:
+                    self.assertAlmostEqual(resolution, protSingle.globalResolution.get(),
+                                           places=2)
+
     def test_confidence_map(self):
         # TODO: Add extra checks (probably comparing to an already saved result?)
         prot = self.runConfidenceMap(self.halfOne, 'Confidence map')
-        return prot
\ No newline at end of file
+        return prot
+
+    def test_confidence_map_batch(self):
+        volumes = self.runImportVolumeSet('Volumes')
+        prot = self.newProtocol(ProtConfidenceMapBatch, inputVolumes=volumes,
+                                objLabel='Batch confidence maps')
+        self.launchProtocol(prot)
+        self.assertEqual(prot.confidenceMaps.getSize(), 2,
+                         "Missing confidence maps in the batch output")
+        self.assertEqual(prot.confidenceMaps_log10FDR.getSize(), 2,
+                         "Missing -log10 FDR maps in the batch output")
+
+        # Each output matches the single protocol on the same volume
+        protSingle = self.runConfidenceMap(self.noisyHalfOne, 'Confidence map (noisy map)')
+        volId = [volume.getObjId() for volume in volumes
+                 if volume.getFileName().endswith('noisy_half_1.mrc')][0]
+        for outputSet, single in [(prot.confidenceMaps, protSingle.confidenceMap),
+                                  (prot.confidenceMaps_log10FDR,
+                                   protSingle.confidenceMap_log10FDR)]:
+            batchMap = ImageHandler().read(outputSet[volId].getFileName()).getData()
+            singleMap = ImageHandler().read(single.getFileName()).getData()
+            self.assertTrue(np.allclose(batchMap, singleMap, atol=1e-3),
+                            "Batch and single confidence maps differ")
+
+    def test_confidence_map_chunked(self):
+        protSpoc = self.runConfidenceMap(self.halfOne, 'Confidence map (SPOC reference)')
+        prot = self.runConfidenceMap(self.halfOne, 'Confidence map (chunked)',
+                                     engine=CONFIDENCE_ENGINE_CHUNKED, slabSize=7)
+        # Same noise model, p-values and BY adjustment as FDRcontrol.py, up to
+        # the binning of the p-values
+        confSpoc = ImageHandler().read(protSpoc.confidenceMap.getFileName()).getData()
+        conf = ImageHandler().read(prot.confidenceMap.getFileName()).getData()
+        logSpoc = ImageHandler().read(protSpoc.confidenceMap_log10FDR.getFileName()).getData()
+        log = ImageHandler().read(prot.confidenceMap_log10FDR.getFileName()).getData()
+        confDiff = np.abs(conf - confSpoc)
+        logDiff = np.abs(log - logSpoc)[np.isfinite(log) & np.isfinite(logSpoc)]
+        print("Chunked vs FDRcontrol.py: confidence max difference %g, -log10 FDR "
+              "median difference %g" % (confDiff.max(), np.median(logDiff)))
+        self.assertLess(confDiff.max(), 1e-2,
+                        "The chunked confidence map differs from FDRcontrol.py")
+        self.assertLess(np.mean((conf > 0.99) != (confSpoc > 0.99)), 1e-3,
+                        "The chunked confidence mask differs from FDRcontrol.py")
+        self.assertLess(np.median(logDiff), 0.05,
+                        "The chunked -log10 FDR map differs from FDRcontrol.py")
+        return prot
+
+    def test_confidence_map_float32(self):
+        prot64 = self.runConfidenceMap(self.halfOne, 'Confidence map (chunked float64)',
+                                       engine=CONFIDENCE_ENGINE_CHUNKED)
+        prot32 = self.runConfidenceMap(self.halfOne, 'Confidence map (chunked float32)',
+                                       engine=CONFIDENCE_ENGINE_CHUNKED, precision=PRECISION_FLOAT32)
+        conf64 = ImageHandler().read(prot64.confidenceMap.getFileName()).getData()
+        conf32 = ImageHandler().read(prot32.confidenceMap.getFileName()).getData()
+        confDiff = np.abs(conf32 - conf64)
+        print("float32 vs float64: confidence max difference %g, mean %g"
+              % (confDiff.max(), confDiff.mean()))
+        self.assertLess(confDiff.max(), 1e-3,
+                        "Confidence differs between float32 and float64")
+
+    def test_confidence_map_noise_boxes(self):
+        prot = self.runConfidenceMap(self.halfOne, 'Confidence map (noise boxes)',
+                                     engine=CONFIDENCE_ENGINE_CHUNKED, box=10,
+                                     noiseBoxes='6 6 30; 54 6 30; 6 54 30; 30 30 30')
+        with open(prot._getExtraPath('noise_boxes.txt')) as f:
+            rows = f.readlines()[1:]
+        self.assertEqual(len(rows), 4, "Missing candidate noise boxes in the report")
+        self.assertIn('signal', rows[3], "The box on the molecule was not flagged")
+
+    def test_confidence_map_rethreshold(self):
+        protConf = self.runConfidenceMap(self.halfOne, 'Confidence map (p-values)',
+                                         engine=CONFIDENCE_ENGINE_CHUNKED)
+        prot = self.newProtocol(ProtConfidenceMapThreshold, inputProtocol=protConf,
+                                objLabel='Re-threshold (same method)')
+        self.launchProtocol(prot)
+        self.assertIsNotNone(prot.confidenceMask,
+                             "There was a problem with the re-threshold output")
+        conf = ImageHandler().read(protConf.confidenceMap.getFileName()).getData()
+        reConf = ImageHandler().read(prot.confidenceMap.getFileName()).getData()
+        self.assertLess(np.abs(conf - reConf).max(), 1e-3,
+                        "Re-thresholding with the same method changed the confidence map")
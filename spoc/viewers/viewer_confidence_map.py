@@ -26,13 +26,14 @@
 # **************************************************************************
 
 
+import numpy as np
 import matplotlib.pyplot as plt
 from matplotlib import cm
 from pwem.wizards import ColorScaleWizardBase
 
 import os
 from pyworkflow.protocol.params import (LabelParam, EnumParam, PointerParam,
-                                        IntParam, LEVEL_ADVANCED)
+                                        IntParam, FloatParam, LEVEL_ADVANCED)
 from pyworkflow.viewer import ProtocolViewer, DESKTOP_TKINTER
 from pwem.viewers import (EmPlotter, ChimeraView, DataView)
 from pwem.viewers.viewer_localres import LocalResolutionViewer
@@ -49,11 +50,14 @@ from pwem.emlib.image import ImageHandler
 
 import chimera
 
-from spoc.protocols.protocol_confidence_map import (ProtConfidenceMap, OUTPUT_MAP, INPUT_MAP)
+from spoc.convert import getMrcShape
+from spoc.viewers.viewer_map_statistics import MapStatisticsViewerMixin
+from spoc.protocols.protocol_confidence_map import (ProtConfidenceMap, OUTPUT_MAP, INPUT_MAP,
+                                                    CONFIDENCE_CUTOFF)
 from pyworkflow.gui import plotter
 
 
-class ProtConfidenceMapViewer(LocalResolutionViewer):
+class ProtConfidenceMapViewer(MapStatisticsViewerMixin, LocalResolutionViewer):
     """Visualization tools for confidence maps results. """
 
     _label = 'viewer confidence maps'
@@ -78,6 +82,11 @@ class ProtConfidenceMapViewer(LocalResolutionViewer):
 
         form.addParam('doShowResHistogram', LabelParam,
                       label="Show confidence map histogram")
+        line = form.addLine('Histogram')
+        line.addParam('histogramBins', IntParam, default=10, label='Bins')
+        line.addParam('histogramCutoff', FloatParam, default=CONFIDENCE_CUTOFF,
+                      label='Lowest value',
+                      help='Only the values above this one are counted')
 
         group = form.addGroup('Colored Slices and Volumes')
         group.addParam('sliceAxis', EnumParam, default=AX_Z,
@@ -136,17 +145,13 @@ class ProtConfidenceMapViewer(LocalResolutionViewer):
 
     def _showVolumeColorSlices(self, param=None):
         imageFile = self.protocol.confidenceMap.getFileName()
-        imgData, _, _, _ = self.getImgData(imageFile)
+        sliceNumbers, matrices = self.getCentralSliceImages(imageFile)
 
         xplotter = EmPlotter(x=2, y=2, mainTitle="Confidence Map Slices "
                                                  "along %s-axis."
                                                  % self._getAxis())
-        # The slices to be shown are close to the center. Volume size is divided
-        # in segments, the fourth central ones are selected i.e. 3,4,5,6
-        for i in list(range(3, 7)):
-            sliceNumber = self.getSlice(i, imgData)
+        for sliceNumber, matrix in zip(sliceNumbers, matrices):
             a = xplotter.createSubPlot("Slice %s" % (sliceNumber + 1), '', '')
-            matrix = self.getSliceImage(imgData, sliceNumber, self._getAxis())
             plot = xplotter.plotMatrix(a, matrix, self.lowest.get(), self.highest.get(),
                                        cmap=self.getColorMap(),
                                        interpolation="nearest")
@@ -159,18 +164,18 @@ class ProtConfidenceMapViewer(LocalResolutionViewer):
 
     def _showOneColorslice(self, param=None):
         imageFile = self.protocol.confidenceMap.getFileName()
-        imgData, _, _, volDims = self.getImgData(imageFile)
+        volDims = getMrcShape(imageFile)
         xplotter = EmPlotter(x=1, y=1, mainTitle="Confidence map Slices "
                                                  "along %s-axis."
                                                  % self._getAxis())
         sliceNumber = self.sliceNumber.get()
         if sliceNumber < 0:
-            sliceNumber = volDims[0] / 2
+            sliceNumber = volDims[0] // 2
         else:
             sliceNumber -= 1
         # sliceNumber has no sense to start in zero
         a = xplotter.createSubPlot("Slice %s" % (sliceNumber + 1), '', '')
-        matrix = self.getSliceImage(imgData, sliceNumber, self._getAxis())
+        matrix = self.getSliceImages(imageFile, [sliceNumber])[0]
         plot = xplotter.plotMatrix(a, matrix, self.lowest.get(), self.highest.get(),
                                    cmap=self.getColorMap(),
                                    interpolation="nearest")
@@ -179,16 +184,11 @@ class ProtConfidenceMapViewer(LocalResolutionViewer):
 
     def _plotHistogram(self, param=None):
         imageFile = self.protocol.confidenceMap.getFileName()
-        img = ImageHandler().read(imageFile)
-        imgData = img.getData()
-        imgList = imgData.flatten()
-        # imgDataMax = self.getBackGroundValue(imgList)
-        imgListNoZero = filter(lambda x: x > 0.1, imgList)
-        nbins = 10
+        counts, edges = self.getHistogram(imageFile)
         plotter = EmPlotter(x=1, y=1, mainTitle="  ")
-        plotter.createSubPlot("Confidence histogram",
-                              "Significance", "# of Counts")
-        plotter.plotHist(imgListNoZero, nbins)
+        a = plotter.createSubPlot("Confidence histogram",
+                                  "Significance", "# of Counts")
+        a.bar(edges[:-1], counts, width=np.diff(edges), align='edge')
         return [plotter]
 
     def _getAxis(self):
@@ -25,7 +25,9 @@
 # **************************************************************************
 
 
+import os
 from os.path import abspath
+import numpy as np
 
 from pyworkflow.viewer import DESKTOP_TKINTER, WEB_DJANGO, ProtocolViewer
 import pyworkflow.protocol.params as params
@@ -34,15 +36,18 @@ from pwem.constants import COLOR_OTHER, AX_Z
 from pyworkflow.protocol.params import (LabelParam, EnumParam, PointerParam,
                                         IntParam, LEVEL_ADVANCED)
 from pwem.viewers import ChimeraView, FscViewer
-from pwem.emlib.image import ImageHandler
+from pwem import splitRange
+from pyworkflow.gui import plotter
 import matplotlib.pyplot as plt
 from matplotlib import cm
 from pwem.viewers import (LocalResolutionViewer, EmPlotter, ChimeraView,
                           DataView)
 
+from spoc.convert import getMrcShape, loadMapStatistics
+from spoc.viewers.viewer_map_statistics import MapStatisticsViewerMixin
 from spoc.protocols.protocol_fsc_fdr_control import ProtResolutionAnalysisFSCFDR
 
-class ViewerFscFdrControl(LocalResolutionViewer):
+class ViewerFscFdrControl(MapStatisticsViewerMixin, LocalResolutionViewer):
     """ Visualize local resolution """
     _label = 'viewer local resolution'
     _targets = [ProtResolutionAnalysisFSCFDR]
@@ -62,6 +67,15 @@ class ViewerFscFdrControl(LocalResolutionViewer):
             form.addParam('doShowLocalRes', params.LabelParam,
                           label="Display the local resolution")
 
+            form.addParam('doShowResHistogram', LabelParam,
+                          label="Show resolution histogram")
+            line = form.addLine('Histogram')
+            line.addParam('histogramBins', IntParam, default=10, label='Bins')
+            line.addParam('histogramCutoff', params.FloatParam, default=0,
+                          label='Lowest value',
+                          help='Only the values above this one are counted. Voxels '
+                               'outside the mask (value 0) are excluded by default.')
+
             group = form.addGroup('Colored resolution Slices and Volumes')
 
             group.addParam('sliceAxis', EnumParam, default=AX_Z,
@@ -108,6 +122,7 @@ class ViewerFscFdrControl(LocalResolutionViewer):
         if self.protocol.localRes.get():
             d2 = {'doShowFSC': self._doShowFSC,
                 'doShowLocalRes': self._doShowLocalRes,
+                'doShowResHistogram': self._plotHistogram,
                 'doShowVolumeColorSlices': self._showVolumeColorSlices,
                 'doShowOneColorslice': self._showOneColorslice,
                 'doShowChimera': self._showChimera
@@ -127,18 +142,14 @@ class ViewerFscFdrControl(LocalResolutionViewer):
 
     def _showVolumeColorSlices(self, param=None):
         imageFile = self.protocol.outputLocalResMap.getFileName()
-        imgData, _, _, _ = self.getImgData(imageFile)
+        sliceNumbers, matrices = self.getCentralSliceImages(imageFile)
 
         xplotter = EmPlotter(x=2, y=2, mainTitle="Confidence Map Slices "
                                                     "along %s-axis."
                                                     % self._getAxis())
 
-        # The slices to be shown are close to the center. Volume size is divided
-        # in segments, the fourth central ones are selected i.e. 3,4,5,6
-        for i in list(range(3, 7)):
-            sliceNumber = self.getSlice(i, imgData)
+        for sliceNumber, matrix in zip(sliceNumbers, matrices):
             a = xplotter.createSubPlot("Slice %s" % (sliceNumber + 1), '', '')
-            matrix = self.getSliceImage(imgData, sliceNumber, self._getAxis())
             plot = xplotter.plotMatrix(a, matrix, self.highest.get(), self.lowest.get(),
                                        cmap=self.getColorMap(),
                                        interpolation="nearest")
@@ -151,18 +162,18 @@ class ViewerFscFdrControl(LocalResolutionViewer):
 
     def _showOneColorslice(self, param=None):
         imageFile = self.protocol.outputLocalResMap.getFileName()
-        imgData, _, _, volDims = self.getImgData(imageFile)
+        volDims = getMrcShape(imageFile)
         xplotter = EmPlotter(x=1, y=1, mainTitle="Confidence map Slices "
                                                     "along %s-axis."
                                                     % self._getAxis())
         sliceNumber = self.sliceNumber.get()
         if sliceNumber < 0:
-            sliceNumber = volDims[0] / 2
+            sliceNumber = volDims[0] // 2
         else:
             sliceNumber -= 1
         # sliceNumber has no sense to start in zero
         a = xplotter.createSubPlot("Slice %s" % (sliceNumber + 1), '', '')
-        matrix = self.getSliceImage(imgData, sliceNumber, self._getAxis())
+        matrix = self.getSliceImages(imageFile, [sliceNumber])[0]
         plot = xplotter.plotMatrix(a, matrix, self.lowest.get(), self.highest.get(),
                                    cmap=self.getColorMap(),
                                    interpolation="nearest")
@@ -171,16 +182,11 @@ class ViewerFscFdrControl(LocalResolutionViewer):
 
     def _plotHistogram(self, param=None):
         imageFile = self.protocol.outputLocalResMap.getFileName()
-        img = ImageHandler().read(imageFile)
-        imgData = img.getData()
-        imgList = imgData.flatten()
-
-        imgListNoZero = imgList
-        nbins = 10
-        plotter = EmPlotter(x=1,y=1,mainTitle="  ")
-        plotter.createSubPlot("Resolution histogram",
-                              "Resolution (A)", "# of Counts")
-        plotter.plotHist(imgListNoZero, nbins)
+        counts, edges = self.getHistogram(imageFile)
+        plotter = EmPlotter(x=1, y=1, mainTitle="  ")
+        a = plotter.createSubPlot("Resolution histogram",
+                                  "Resolution (A)", "# of Counts")
+        a.bar(edges[:-1], counts, width=np.diff(edges), align='edge')
         return [plotter]
 
     def _getAxis(self):
@@ -209,7 +215,11 @@ class ViewerFscFdrControl(LocalResolutionViewer):
         if self.sharpenedMap.get():
 
             imageFile = os.path.abspath(fnResVol)
-            _, minRes, maxRes, voldim = self.getImgData(imageFile)
+            stats = loadMapStatistics(imageFile)
+            if stats is not None:
+                minRes, maxRes = float(stats['minValue']), float(stats['maxValue'])
+            else:
+                _, minRes, maxRes, voldim = self.getImgData(imageFile)
             # Narrow the color range to the highest resolution range
             lowResLimit = min(maxRes, minRes + 5)
             highResLimit = minRes
@@ -0,0 +1,67 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team (scipion@cnb.csic.es)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+
+
+
+import numpy as np
+
+from spoc.convert import (getMrcShape, readSlices, computeHistogram,
+                          rebinHistogram, getCentralSlices, loadMapStatistics)
+
+
+class MapStatisticsViewerMixin:
+    """ Slices and histograms of the output maps of the SPOC viewers, read
+    from the statistics files written by the protocols when available. The
+    viewer must define _getAxis and the histogramCutoff and histogramBins
+    parameters. """
+
+    def getSliceImages(self, imgFile, sliceNumbers):
+        """ Read only the requested slices (along the selected axis) through a
+        memory map, masking the values below 0.1 as getImgData does. """
+        slices = readSlices(imgFile, sliceNumbers, self._getAxis())
+        return [np.ma.masked_where(matrix < 0.1, matrix) for matrix in slices]
+
+    def getCentralSliceImages(self, imgFile):
+        """ The four central slices along the selected axis, taken from the
+        statistics file written by the protocol when it is available. """
+        axis = self._getAxis()
+        stats = loadMapStatistics(imgFile)
+        if stats is None:
+            axisSize = getMrcShape(imgFile)['zyx'.index(axis)]
+            sliceNumbers = getCentralSlices(axisSize)
+            return sliceNumbers, self.getSliceImages(imgFile, sliceNumbers)
+        return (list(stats['sliceNumbers_%s' % axis]),
+                [np.ma.masked_where(matrix < 0.1, matrix)
+                 for matrix in stats['slices_%s' % axis]])
+
+    def getHistogram(self, imgFile):
+        """ Histogram counts and edges, from the statistics file when it was
+        computed with the same cutoff. """
+        stats = loadMapStatistics(imgFile)
+        if stats is not None and np.isclose(stats['cutoff'], self.histogramCutoff.get()):
+            return rebinHistogram(stats['counts'], stats['edges'],
+                                  self.histogramBins.get())
+        return computeHistogram(imgFile, bins=self.histogramBins.get(),
+                                minValue=self.histogramCutoff.get())